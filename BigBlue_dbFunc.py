@@ -88,7 +88,7 @@ BigBlue
 
 class  BigBlue():
 
-    def __init__(self, user, password, stm_file, database='cryo_stm_data', logging_level='INFO'):
+    def __init__(self, user, password, stm_file, database='cryo_stm_data', logging_level='INFO', fileobj=None):
         self.user = user  # SQL database Username.
         self.password = password  # SQL database password.
 
@@ -100,11 +100,12 @@ class  BigBlue():
         # Each experimental system has it's own database. Default at the moment is the cyro as this is the test case.
         self.database = database
 
-        # stm_file: Must be a path that leads to an Omicron .Flat file.
+        # stm_file: Must be a path that leads to an Omicron .Flat file, which can be inside a zip or tar archive,
+        # e.g. data.tar.gz/run/file.Z_flat. fileobj: optional file object the file is read from instead.
 
         # Load Flat File data from stm_file. Also creates stm_filePath and stm_fileName and self.stm_file is defined as
         # a flatfile object from the flatfile module.
-        self.get_stmFile(stm_file)
+        self.get_stmFile(stm_file, fileobj)
 
         # Get Flat File data type
         self.get_dataType(self.stm_file)
@@ -124,9 +125,6 @@ class  BigBlue():
         # Test and format creation comment for use in SQL database
         self.commentTest(self.creation_comment)
 
-        # Get stm data from file
-        self.get_stmData(self.stm_file)
-
     """
     Logging Funcs
     """
@@ -158,13 +156,15 @@ class  BigBlue():
     """
     Flat File manipulation
     """
-    def get_stmFile(self, stm_file):
-        """ the input stm_file is the full path to the desired Omicron Flat file.
-        It is then replaced by the loaded data that has been parsed by ff."""
+    def get_stmFile(self, stm_file, fileobj=None):
+        """ the input stm_file is the full path to the desired Omicron Flat file, possibly inside an archive.
+        It is then replaced by the loaded data that has been parsed by ff, read from fileobj if given.
+        Only the header is loaded, the data of each scan is None: use ff.load(self.stm_filePath) to read them."""
         # FIXME: The replacement of stm_file with stm_file might be stupid, at the very least it is confusing.
         self.stm_filePath = os.path.normpath(stm_file)
         self.stm_fileName = self.stm_filePath.split('\\')[-1]  # Takes last element of split path to get file name.
-        self.stm_file = ff.load(self.stm_filePath)  # Uses ff. to parse the file.
+        # Only the metadata are entered in the database, so the raw data are skipped and not decoded.
+        self.stm_file = ff.read_header(self.stm_filePath, fileobj).getData()  # Uses ff. to parse the file.
 
     def get_numberOfScans(self, stm_file):
         """ Gets the number of data files within the stm_file. I.E. for a topograph with fwd, bck and up, down images
@@ -252,15 +252,6 @@ class  BigBlue():
                     raise CreationCommentError('Creation comment of %s does not match expected format'
                                                % self.stm_fileName)
 
-    def ret_stmData(self, stm_file, scan_dir=0):
-        """ Returns the experimental data from a specified ff[scan_dir] object."""
-        return stm_file[scan_dir].data
-
-    def get_stmData(self, stm_file):
-        self.stm_data = []
-        for i in range(0, self.numberOfScans):
-            self.stm_data.append(self.ret_stmData(stm_file, scan_dir=i))
-
     """
     %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
     %%%           SQL Funcs           %%%
@@ -1,36 +1,222 @@
 __author__ = 'Tobias Gill'
 
 import os
+import io
+import stat
+import Queue
+import threading
 import BigBlue_dbFunc as bb
+import flatfile as ff
 
-def ret_files(path):
+try:
+    from os import scandir
+except ImportError: # Python 2, the backport if installed
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+def iter_flat_files(path):
     '''
-    Returns all flat file names in the directory in path
+    Yields (file name, file path, file object) for the flat files in the
+    directory or in the zip or tar archive in path. The files of an archive
+    are read in a single pass without being extracted, their file object is
+    only valid until the next one is yielded. It is None for a directory.
     '''
 
-    all_files = os.listdir(path)
+    if ff.is_archive(path):
+        for member_path, member in ff.iter_archive(path):
+            if member_path.lower().endswith('flat'):
+                yield os.path.relpath(member_path, path), member_path, member
+    else:
+        for name in os.listdir(path):
+            if name.lower().endswith('flat'):
+                yield name, os.path.join(path, name), None
 
-    for i in range(0, len(all_files)):
-        if all_files[i][-4:] != 'flat':
-            all_files.remove(all_files[i])
+def _list_dir(path):
+    '''
+    Returns the paths of the subdirectories and the (path, size, mtime) of the
+    flat files in the directory path, listed with a single scandir() call
+    when available. The entries removed while listing are ignored. As with
+    os.walk(), the symbolic links to directories are not followed.
+    '''
 
-    topo_files = []
-    for i in range(0, len(all_files)):
-        if all_files[i][-6:] == 'Z_flat':
-            topo_files.append(all_files[i])
+    subdirs = []
+    files = []
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.name.lower().endswith('flat'):
+                    entry_stat = entry.stat()
+                    files.append((entry.path, entry_stat.st_size,
+                                  entry_stat.st_mtime))
+            except OSError:
+                continue
+    else:
+        for name in os.listdir(path):
+            entry_path = os.path.join(path, name)
+            try:
+                if stat.S_ISDIR(os.lstat(entry_path).st_mode):
+                    subdirs.append(entry_path)
+                elif name.lower().endswith('flat'):
+                    entry_stat = os.stat(entry_path)
+                    files.append((entry_path, entry_stat.st_size,
+                                  entry_stat.st_mtime))
+            except OSError:
+                continue
+    return subdirs, files
+
+def _scan_dir(path, sniff):
+    '''
+    Returns the subdirectories of path and the (path, size, mtime, kind) of
+    its flat files, kind is None if not sniffed or not recognised.
+    '''
+
+    try:
+        subdirs, files = _list_dir(path)
+    except OSError, error:
+        print 'Skipping %s: %s' % (path, error)
+        return [], []
+
+    scanned = []
+    for file_path, size, mtime in files:
+        kind = None
+        if sniff:
+            try:
+                kind = ff.sniff(file_path)['kind']
+            except (ff.Error, IOError):
+                pass
+        scanned.append((file_path, size, mtime, kind))
+    return subdirs, scanned
+
+def scan_files(path, recursive=True, threads=0, sniff=True):
+    '''
+    Yields (file path, size, mtime, kind) for the flat files in the directory
+    path and, if recursive, in all its subdirectories. Each directory is
+    listed once with scandir() and each file is classified from its header
+    with flatfile.sniff(), kind is 'topo', 'ivcurve', 'ivmap', 'izcurve' or
+    None. With threads, the subdirectories are scanned by as many threads,
+    which hides the latency of network filesystems, the files are then
+    yielded in no particular order.
+    '''
+
+    if threads <= 0:
+        directories = [path]
+        while directories:
+            subdirs, files = _scan_dir(directories.pop(), sniff)
+            for scanned in files:
+                yield scanned
+            if recursive:
+                directories.extend(reversed(subdirs))
+        return
 
+    directories = Queue.Queue()
+    results = Queue.Queue()
+
+    def worker():
+        while True:
+            directory = directories.get()
+            if directory is None:
+                return
+            try:
+                results.put(_scan_dir(directory, sniff) + (None,))
+            except Exception, error:
+                results.put(([], [], error))
+
+    workers = [threading.Thread(target=worker) for i in range(threads)]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        directories.put(path)
+        pending = 1
+        while pending:
+            subdirs, files, error = results.get()
+            pending -= 1
+            if error is not None:
+                raise error
+            if recursive:
+                for subdir in subdirs:
+                    directories.put(subdir)
+                pending += len(subdirs)
+            for scanned in files:
+                yield scanned
+    finally:
+        # Stop the workers, even if the caller stopped iterating
+        try:
+            while True:
+                directories.get_nowait()
+        except Queue.Empty:
+            pass
+        for thread in workers:
+            directories.put(None)
+        for thread in workers: # each one finishes its current directory
+            thread.join()
+
+def ret_files(path):
+    '''
+    Returns all flat file names in the directory or the archive in path, and
+    the topography and spectroscopy files among them. The files are
+    classified from their header with flatfile.sniff(), not from their name.
+    '''
+
+    all_files = []
+    topo_files = []
     spec_files = []
-    for i in range(0, len(all_files)):
-        if all_files[i][-12:] == 'Aux1(V)_flat' or all_files[i][-12:] == 'Aux2(V)_flat' \
-                or all_files[i][-9:] == 'I(V)_flat':
-            spec_files.append(all_files[i])
+    for file_name, file_path, file_obj in iter_flat_files(path):
+        all_files.append(file_name)
+        try:
+            kind = ff.sniff(file_path, file_obj)['kind']
+        except (ff.Error, IOError):
+            continue
+        if kind == 'topo':
+            topo_files.append(file_name)
+        elif kind in ('ivcurve', 'ivmap', 'izcurve'):
+            spec_files.append(file_name)
 
     return all_files, topo_files, spec_files
 
 def add_multiple_files(path, list, username, password):
+    '''
+    Adds the flat files of list in the directory or the archive in path to the
+    database. Each file is checked with flatfile.validate() first, the
+    truncated or corrupt files are skipped. Returns the list of (file name,
+    error) of the skipped files. The files of an archive are read in a single
+    pass, each one is held in memory while it is added, none is extracted.
+    '''
 
-    for i in range(len(list)):
-        temp_data_path = os.path.join(path, list[i])
-        tempData = bb.BigBlue(username, password, temp_data_path)
+    if ff.is_archive(path):
+        wanted = set(list)
+        files = ((file_name, file_path, io.BytesIO(file_obj.read()))
+                 for file_name, file_path, file_obj in iter_flat_files(path)
+                 if file_name in wanted)
+    else:
+        files = ((file_name, os.path.join(path, file_name), None)
+                 for file_name in list)
+
+    skipped = []
+    found = set()
+    for file_name, file_path, file_obj in files:
+        found.add(file_name)
+        try:
+            ff.validate(file_path, file_obj)
+        except (ff.Error, IOError, OSError), error:
+            print 'Skipping %s: %s' % (file_name, error)
+            skipped.append((file_name, error))
+            continue
+        if file_obj is not None:
+            file_obj.seek(0)
+        tempData = bb.BigBlue(username, password, file_path, fileobj=file_obj)
         tempData.add_entry()
-        del tempData, temp_data_path
\ No newline at end of file
+        del tempData, file_path, file_obj
+
+    for file_name in list:
+        if file_name not in found:
+            error = IOError('No file %s in %s' % (file_name, path))
+            print 'Skipping %s: %s' % (file_name, error)
+            skipped.append((file_name, error))
+
+    return skipped
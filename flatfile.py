@@ -51,13 +51,54 @@
 """
 
 from __future__ import division
-from struct import unpack
+from struct import Struct
 import datetime
+from collections import OrderedDict, Mapping, MutableMapping
 from pylab import *
+from numpy.lib.stride_tricks import as_strided
 import os.path
+import time
+import zipfile
+import tarfile
+import multiprocessing
+from contextlib import contextmanager
+import flatfile_cache
 
 DEBUG = False
 
+# Number of raw data values read at once
+DATA_BLOCK_SIZE = 2**20
+
+# Size in bytes of the block read by sniff(), enough for the axis hierarchy
+# of the usual files
+SNIFF_BUFFER_SIZE = 1024
+
+# Number of values of the blocks of grid spectroscopy data returned by
+# FlatFile.iterSlices(), iterTiles() and iterSpectra()
+CHUNK_SIZE = 2**21
+
+# Size in bytes of the blocks read from the file to parse the header and the
+# trailer, small files are read in a single block.
+BUFFER_SIZE = 2**16
+
+# Persistent cache of the parsed files, see enable_disk_cache()
+diskCache = None
+
+# Record the time, bytes read and read calls of each section of the parsed
+# files, see enable_profiling()
+profiling = False
+profileHook = None
+
+# Maximum total size in bytes of the data arrays kept in memory by load()
+MEMORY_CACHE_SIZE = 2**29
+
+# FlatFile attributes stored in the disk cache along with the data
+CACHED_ATTRIBUTES = ('axis_keys', 'axis', 'dimension', 'channel',
+                     'transferFunction', 'dataView', 'creationInformation',
+                     'brickletSize', 'dataItemSize', 'dataOffset', 'offset',
+                     'experimentInfo', 'experimentElement',
+                     'experimentDeployement')
+
 class Error(Exception):
     """Base class for exceptions in this module. """
     pass
@@ -78,25 +119,780 @@ class OutOfBoundError(Error):
     """Occurs if the value choosed is out of measured boundaries."""
     pass
 
-class DataArray():
+class UnhandledTransferFunction(Error):
+    """Occurs if the transfer function of the channel is unknown."""
+    pass
+
+class CorruptFileError(UnhandledFileError):
+    """Occurs if the file is truncated or malformed. The filename, the section
+       being parsed and the offset in bytes of the problem are available as
+       attributes of the error."""
+
+    def __init__(self, filename, section, offset, message):
+        UnhandledFileError.__init__(self, filename, section, offset, message)
+        self.filename = filename
+        self.section = section
+        self.offset = offset
+        self.message = message
+
+    def locate(self, filename, section):
+        """Set the filename and section if they are not known yet"""
+
+        if self.filename is None:
+            self.filename = filename
+        if self.section is None:
+            self.section = section
+        self.args = (self.filename, self.section, self.offset, self.message)
+
+    def __str__(self):
+        return '%s: %s at byte %s in section %s' % (self.filename,
+                self.message, self.offset, self.section)
+
+class _Cursor():
+    """Decode the values of a flat file from an in-memory buffer.
+
+       The file is read by blocks of BUFFER_SIZE bytes and the values are
+       unpacked in place from the block with precompiled structures, so
+       parsing the sections made of thousands of small values costs only a few
+       file.read() calls.
+    """
+    unpackInt = Struct('<i').unpack_from
+    unpackLong = Struct('<q').unpack_from
+    unpackDouble = Struct('<d').unpack_from
+
+    def __init__(self, file, buffer=''):
+        """ \arg file open in binary mode, or None to decode only buffer.
+            \arg buffer bytes preceding the current position of the file.
+        """
+        self.file = file
+        self.bufferSize = BUFFER_SIZE
+        self.buffer = buffer
+        self.position = 0 # position in the buffer
+        self.end = len(buffer) # size of the buffer
+        # position of the buffer in the file
+        self.offset = file.tell() - self.end if file is not None else 0
+        self.bytesRead = 0 # bytes and calls of file.read()
+        self.readCount = 0
+
+    def tell(self):
+        """Return the position of the cursor in the file"""
+
+        return self.offset + self.position
+
+    def _require(self, size):
+        """Make sure that size bytes are available in the buffer"""
+
+        available = self.end - self.position
+        if available < size :
+            if self.file is None :
+                data = ''
+            else :
+                data = self.file.read(max(self.bufferSize, size - available))
+            self.bytesRead += len(data)
+            self.readCount += 1
+            self.buffer = self.buffer[self.position:] + data
+            self.offset += self.position
+            self.position = 0
+            self.end = len(self.buffer)
+            if self.end < size :
+                raise CorruptFileError(None, None, self.offset + self.end,
+                                       'Unexpected end of file')
+
+    def skip(self, size):
+        """Move the cursor size bytes forward, seek the file if needed"""
+
+        if self.position + size <= self.end :
+            self.position += size
+        else :
+            self.offset = self.tell() + size
+            self.file.seek(self.offset)
+            self.buffer = ''
+            self.position = 0
+            self.end = 0
+
+    def read(self, size):
+        """Return the next size bytes"""
+
+        if self.position + size > self.end :
+            self._require(size)
+        self.position += size
+        return self.buffer[self.position-size:self.position]
+
+    def loadRemaining(self):
+        """Read all the bytes up to the end of the file in the buffer, the
+           positions in the buffer are then stable up to the end. """
+
+        remaining = self.file.read()
+        self.bytesRead += len(remaining)
+        self.readCount += 1
+        self.buffer = self.buffer[self.position:] + remaining
+        self.offset += self.position
+        self.position = 0
+        self.end = len(self.buffer)
+
+    def readRemaining(self):
+        """Return all the bytes up to the end of the file"""
+
+        remaining = self.file.read() if self.file is not None else ''
+        self.bytesRead += len(remaining)
+        self.readCount += 1
+        data = self.buffer[self.position:] + remaining
+        self.offset = self.tell() + len(data)
+        self.buffer = ''
+        self.position = 0
+        self.end = 0
+        return data
+
+    def readString(self):
+        """Read a Omicron string, stored as UTF-16 characters preceded with
+           an integer corresponding to the length of the string"""
+
+        position = self.position + 4
+        if position > self.end :
+            self._require(4)
+            position = self.position + 4
+        length = self.unpackInt(self.buffer, position - 4)[0]
+        if length :
+            end = position + 2 * length
+            if end > self.end :
+                self.position = position
+                self._require(2 * length)
+                position = self.position
+                end = position + 2 * length
+            self.position = end
+            return unicode( self.buffer[position:end], 'utf16', 'replace' ) # 16 bits unicode character
+        else :
+            self.position = position
+            return None
+
+    def skipString(self):
+        """Move the cursor after a Omicron string without decoding it"""
+
+        position = self.position + 4
+        if position > self.end :
+            self._require(4)
+            position = self.position + 4
+        size = 2 * self.unpackInt(self.buffer, position - 4)[0]
+        if size < 0 :
+            raise CorruptFileError(None, None, self.offset + position - 4,
+                                   'Invalid string length %i' % (size // 2))
+        if position + size > self.end :
+            self.position = position
+            self._require(size)
+            position = self.position
+        self.position = position + size
+
+    def readInt(self):
+        position = self.position + 4
+        if position > self.end :
+            self._require(4)
+            position = self.position + 4
+        self.position = position
+        return self.unpackInt(self.buffer, position - 4)[0]
+
+    def readLong(self):
+        if self.position + 8 > self.end :
+            self._require(8)
+        self.position += 8
+        return self.unpackLong(self.buffer, self.position-8)[0]
+
+    def readDouble(self):
+        if self.position + 8 > self.end :
+            self._require(8)
+        self.position += 8
+        return self.unpackDouble(self.buffer, self.position-8)[0]
+
+    def readIntArray(self, count):
+        if self.position + 4 * count > self.end :
+            self._require(4 * count)
+        self.position += 4 * count
+        return frombuffer(self.buffer, dtype='<i4', count=count,
+                          offset=self.position - 4 * count)
+
+class _ArchiveFile():
+    """Read-only file object over a member of a zip or tar archive. The member
+       is decompressed as it is read, seeking forward reads and drops the
+       skipped bytes, seeking backward is not possible."""
+
+    def __init__(self, fileobj, size, archive=None):
+        """ \arg fileobj the member file object given by the archive.
+            \arg size uncompressed size of the member.
+            \arg archive the ZipFile or TarFile, closed with the member.
+        """
+        self.fileobj = fileobj
+        self.size = size
+        self.archive = archive
+        self.position = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.size - self.position
+        blocks = []
+        while size > 0:
+            data = self.fileobj.read(size)
+            if not data:
+                break
+            blocks.append(data)
+            size -= len(data)
+        data = ''.join(blocks)
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+        if offset < self.position:
+            raise IOError('Cannot seek backward in an archive member')
+        while self.position < offset:
+            if not self.read(min(offset - self.position, BUFFER_SIZE)):
+                break
+
+    def close(self):
+        self.fileobj.close()
+        if self.archive is not None:
+            self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def is_archive(path):
+    """Return True if path is a zip or tar archive, compressed or not."""
+
+    return os.path.isfile(path) and \
+           (zipfile.is_zipfile(path) or tarfile.is_tarfile(path))
+
+def _splitArchivePath(path):
+    """Split the path of an archive member, e.g. data.tar.gz/run/file.Z_flat,
+       into the archive path and the member name. Return (None, None) if no
+       parent of path is an archive."""
+
+    head, parts = os.path.normpath(path), []
+    while head and not os.path.exists(head):
+        head, tail = os.path.split(head)
+        if not tail:
+            break
+        parts.insert(0, tail)
+    if parts and is_archive(head):
+        return head, '/'.join(parts)
+    return None, None
+
+def _openFile(filename):
+    """Open filename for reading, which can also be the path of a member of
+       a zip or tar archive, see _splitArchivePath(). Return the file object
+       and the size of the file."""
+
+    path = os.path.normpath(filename)
+    if not os.path.exists(path):
+        archive, member = _splitArchivePath(path)
+        if archive is not None:
+            return _openArchiveMember(archive, member)
+    flatFile = open(path, 'rb')
+    return flatFile, os.fstat(flatFile.fileno()).st_size
+
+def _openArchiveMember(archive, member):
+    """Return an _ArchiveFile on member of archive and its size. Members of
+       compressed tar archives are found by decompressing the archive up to
+       them, use iter_archive() to read many of them."""
+
+    try:
+        if zipfile.is_zipfile(archive):
+            zipFile = zipfile.ZipFile(archive)
+            try:
+                info = zipFile.getinfo(member)
+                return _ArchiveFile(zipFile.open(info), info.file_size,
+                                    zipFile), info.file_size
+            except:
+                zipFile.close()
+                raise
+        else:
+            tarFile = tarfile.open(archive)
+            try:
+                info = tarFile.getmember(member)
+                if not info.isfile():
+                    raise KeyError(member)
+                return _ArchiveFile(tarFile.extractfile(info), info.size,
+                                    tarFile), info.size
+            except:
+                tarFile.close()
+                raise
+    except KeyError:
+        raise IOError('No file %s in the archive %s' % (member, archive))
+    except (zipfile.BadZipfile, tarfile.TarError), error:
+        raise IOError('Unable to read the archive %s: %s' % (archive, error))
+
+def _fileSize(fileobj):
+    """Return the size of a file object opened by the caller"""
+
+    size = getattr(fileobj, 'size', None)
+    if size is None:
+        position = fileobj.tell()
+        fileobj.seek(0, 2)
+        size = fileobj.tell()
+        fileobj.seek(position)
+    return size
+
+@contextmanager
+def _opened(filename, fileobj=None):
+    """Yield (file, size) of filename, or of fileobj if given, which is
+       left open."""
+
+    if fileobj is not None:
+        yield fileobj, _fileSize(fileobj)
+        return
+    flatFile, size = _openFile(filename)
+    try:
+        yield flatFile, size
+    finally:
+        flatFile.close()
+
+def iter_archive(archive):
+    """Yield (path, file) for the files of a zip or tar archive in their
+    order in the archive, reading it in a single pass. path is the archive
+    path joined with the member name, as accepted by load(), and file is only
+    valid until the next one is yielded. E.g. to reanalyse a compressed
+    archive without extracting it:
+
+        for path, member in iter_archive('run.tar.gz'):
+            data = FlatFile(path, fileobj=member).getData()
+    """
+
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zipFile:
+            for info in zipFile.infolist():
+                if info.filename.endswith('/'): # directory
+                    continue
+                member = _ArchiveFile(zipFile.open(info), info.file_size)
+                try:
+                    yield os.path.join(archive, info.filename), member
+                finally:
+                    member.close()
+    else:
+        with tarfile.open(archive, 'r|*') as tarFile:
+            for info in tarFile:
+                if info.isfile():
+                    yield os.path.join(archive, info.name), \
+                          _ArchiveFile(tarFile.extractfile(info), info.size)
+
+class MemoryCache():
+    """Least recently used cache of the files returned by load().
+
+       The cache is bounded by the total size in bytes of the data arrays it
+       holds rather than by a number of files, a file bigger than the whole
+       budget is never cached. Set maxBytes to 0 to disable the cache.
+    """
+    def __init__(self, maxBytes=MEMORY_CACHE_SIZE):
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict() # the least recently used first
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, version):
+        """Return the data cached for key if it has the same version
+           (e.g. file size and modification time), None otherwise."""
+
+        entry = self.entries.pop(key, None)
+        if entry is not None and entry[0] != version:
+            self.nbytes -= entry[1]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.entries[key] = entry # now the most recently used
+        self.hits += 1
+        return entry[2]
+
+    def put(self, key, version, data, nbytes):
+        """Cache data of size nbytes, evict the least recently used entries
+           to stay in the budget."""
+
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[1]
+        if nbytes > self.maxBytes:
+            return
+
+        self.entries[key] = (version, nbytes, data)
+        self.nbytes += nbytes
+
+        while self.nbytes > self.maxBytes:
+            self.nbytes -= self.entries.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        """Return a dictionary of the cache statistics"""
+
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'nbytes': self.nbytes,
+                'maxBytes': self.maxBytes}
+
+def _decodeElementParameters(cursor, parameterCount):
+    """Decode the parameters of an experiment element """
+
+    readString = cursor.readString
+    readInt = cursor.readInt
+    parameters = {}
+
+    for j in range(parameterCount) :
+
+        parameterName = readString()
+        parameterTypeCode = readInt()
+        parameterUnit = readString()
+        parameterValue = readString()
+
+        # Every value is passed as a string but can
+        # represent different object type according
+        # to the given parameter type code
+        if parameterTypeCode == 1 :   # 32bits integer
+            parameterValue = int(parameterValue)
+        elif parameterTypeCode == 2 : # Double precision float
+            parameterValue = float(parameterValue)
+        elif parameterTypeCode == 3 : # Boolean
+            if parameterValue == 'true' :
+                parameterValue = True
+            else :
+                parameterValue = False
+        elif parameterTypeCode == 4 : # Enum
+            parameterValue = parameterValue # FIXME unhandled, since never used
+        elif parameterTypeCode == 5 : # Unicode character string
+            parameterValue = parameterValue
+        else :
+            raise ParameterTypeError, 'Unknown parameter type %i given' % parameterTypeCode
+
+        parameters[parameterName] = {
+            'value': parameterValue,
+            'unit' : parameterUnit
+            }
+        # Note: parameterUnit can be = u'--' which means no unit.
+
+    return parameters
+
+def _decodeDeployement(cursor, deploymentCount):
+    """Decode the parameters of a deployment instance """
+
+    readString = cursor.readString
+    parameters = {}
+    for j in range(deploymentCount) :
+        parameters[readString()] = readString()
+    return parameters
+
+class ParameterSection(MutableMapping):
+    """Dictionary of the instances of the experiment element or deployment
+       parameters of a file.
+
+       The instances are indexed by their offset in the raw bytes of the
+       section and decoded on first access, most files are only read for a
+       few of them. The section is pickled as a plain decoded dictionary.
+    """
+
+    def __init__(self, data, index, decode):
+        """ \arg data raw bytes of the section.
+            \arg index dictionary of (offset, parameter count) of each
+            instance in data.
+            \arg decode function(cursor, count) returning the dictionary of
+            the parameters of an instance.
+        """
+        self.data = data
+        self.index = index
+        self.decode = decode
+        self.decoded = {}
+
+    def __getitem__(self, name):
+        if name in self.decoded:
+            return self.decoded[name]
+
+        offset, count = self.index[name]
+        cursor = _Cursor(None, self.data)
+        cursor.skip(offset)
+        parameters = self.decode(cursor, count)
+        self.decoded[name] = parameters
+        return parameters
+
+    def __setitem__(self, name, parameters):
+        self.decoded[name] = parameters
+        if name not in self.index:
+            self.index[name] = None
+
+    def __delitem__(self, name):
+        del self.index[name]
+        self.decoded.pop(name, None)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+    def __reduce__(self):
+        return dict, (dict(self.iteritems()),)
+
+class DataInfo(object):
+    """Read-only dictionary holding the physical information on the data of
+       a DataArray: the information shared by all the scan directions of the
+       file plus the direction of the DataArray.
+    """
+    __slots__ = ('fileInfo', 'direction')
+
+    def __init__(self, fileInfo, direction):
+        self.fileInfo = fileInfo
+        self.direction = direction
+
+    def __getitem__(self, key):
+        if key == 'direction':
+            return self.direction
+        return self.fileInfo[key]
+
+    def get(self, key, default=None):
+        if key == 'direction':
+            return self.direction
+        return self.fileInfo.get(key, default)
+
+    def __contains__(self, key):
+        return key == 'direction' or key in self.fileInfo
+
+    has_key = __contains__
+
+    def __iter__(self):
+        yield 'direction'
+        for key in self.fileInfo:
+            if key != 'direction':
+                yield key
+
+    iterkeys = __iter__
+
+    def __len__(self):
+        return len(self.fileInfo) + ('direction' not in self.fileInfo)
+
+    def keys(self):
+        return list(self)
+
+    def iteritems(self):
+        for key in self:
+            yield key, self[key]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def itervalues(self):
+        for key in self:
+            yield self[key]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def copy(self):
+        """Return a modifiable dictionary of the info"""
+
+        info = dict(self.fileInfo)
+        info['direction'] = self.direction
+        return info
+
+    def __eq__(self, other):
+        if isinstance(other, Mapping):
+            return self.copy() == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __repr__(self):
+        return repr(self.copy())
+
+Mapping.register(DataInfo)
+
+class DataArray(object):
     """A simple class holding the minimal structure for storing STM data.
        The data is a numpy array with the right shape according to the type of
        data (i.e a vector for curve, a matrix for images, a 3d matrix for maps.)
-       Info is a python dictionary to store physical information on the data.
+       Info is a read-only dictionary to store physical information on the
+       data, see DataInfo. The scan directions of a file share the same
+       fileInfo dictionary, only their direction differ.
+
+       The data of a flat file are kept as the raw 32 bits integer counts,
+       half the size of the physical values. They are converted with the
+       transfer function the first time data is accessed, the counts are then
+       dropped so only the float64 values are held. toPhysical() returns a
+       private copy of another dtype, e.g. float32, and keeps the counts.
+       Statistics such as histograms or masks can be computed directly on the
+       counts as long as data was not accessed.
     """
-    def __init__(self, data, info):
-        self.data = data # is a nupmy matrix
-        self.info = info.copy() # a simple dictionary
+    __slots__ = ('counts', 'transferFunction', 'valid', '_data', 'direction',
+                 'fileInfo')
+
+    def __init__(self, data, info, direction=None, transferFunction=None):
+        """ \arg data physical values, or raw data counts if transferFunction
+            is given.
+            \arg info dictionary shared by all the scan directions, it must
+            not be modified afterwards.
+            \arg direction the scan direction, taken from info if None.
+            \arg transferFunction converting the counts to physical values.
+        """
+        if transferFunction is None:
+            self.counts = None
+            self._data = data # is a nupmy matrix
+        else:
+            self.counts = data
+            self._data = None
+        self.transferFunction = transferFunction
+        self.valid = None # Mask of the measured counts of incomplete files
+        self.fileInfo = info
+        if direction is None:
+            direction = info.get('direction')
+        self.direction = direction
+
+    def toPhysical(self, dtype=float64):
+        """Return a new array of the physical values with the given dtype,
+           e.g. float32 to halve the memory. """
+
+        if self.counts is None:
+            return array(self._data, dtype=dtype)
+
+        data = empty(self.counts.shape, dtype=dtype)
+        if self.counts.ndim > 1:
+            # Convert slice by slice, so the float64 temporaries stay small
+            for i in range(len(data)):
+                data[i] = self.transferFunction(self.counts[i])
+        else:
+            data[...] = self.transferFunction(self.counts)
+        if self.valid is not None:
+            data[~self.valid] = 0
+        return data
+
+    def _getData(self):
+        if self._data is None and self.counts is not None:
+            data = self.toPhysical()
+            data.flags.writeable = self.counts.flags.writeable
+            self._data = data
+            # Not kept along with the physical values
+            self.counts = None
+            self.valid = None
+        return self._data
+
+    def _setData(self, data):
+        self._data = data
+
+    data = property(_getData, _setData)
+
+    def _getInfo(self):
+        return DataInfo(self.fileInfo, self.direction)
+
+    def _setInfo(self, info):
+        self.fileInfo = dict(info)
+        self.direction = info.get('direction')
+
+    info = property(_getInfo, _setInfo)
+
+    def __getstate__(self):
+        data = self._data
+        if self.counts is not None:
+            data = None # Converted again when needed
+        return (self.counts, self.transferFunction, self.valid, data,
+                self.fileInfo, self.direction)
+
+    def __setstate__(self, state):
+        (self.counts, self.transferFunction, self.valid, self._data,
+         self.fileInfo, self.direction) = state
+
+class TransferFunction():
+    """Convert the raw data counts to physical values.
+
+       Known functions are :
+           TFF_Linear1D : phys = ( raw - offset ) / f
+           TFF_MultiLinear1D : phys = ( raw_1 - offset_pre ) * ( raw - offset ) / f_neutral / f_pre
+
+       The conversion works on a single value as well as on a numpy array, the
+       operations are done in the same order in both cases so the result is
+       identical.
+    """
+    def __init__(self, name, parameters):
+        self.name = name
+        self.parameters = parameters
+
+    def __call__(self, z):
+        p = self.parameters
+        if 'TFF_Linear1D' == self.name :
+            return ( z - p['Offset'] ) / p['Factor']
+        else : # TFF_MultiLinear1D
+            return ( p['Raw_1'] - p['PreOffset'] ) * ( z - p['Offset'] ) / p['NeutralFactor'] / p['PreFactor']
+
+class MappedData():
+    """Read-only view on the raw data counts mapped from the file.
+
+       Only the accessed slice is read from the disk and converted to physical
+       values, e.g. data[10] for a single slice of a grid spectroscopy.
+       Use numpy.asarray(data) to convert the whole array at once.
+    """
+    def __init__(self, raw, transferFunction):
+        self.raw = raw # numpy view on a numpy.memmap
+        self.transferFunction = transferFunction
+        self.shape = raw.shape
+        self.ndim = raw.ndim
+        self.size = raw.size
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getitem__(self, key):
+        return self.transferFunction(asarray(self.raw[key]))
+
+    def __array__(self, dtype=None):
+        data = self.transferFunction(asarray(self.raw))
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
 
 class FlatFile():
     """ The FlatFile class is able to parse the
         Omicron Flat File Format.
     """
 
-    def __init__(self, filename):
-        """ \arg filename should be a valid path to a omicron flat file."""
+    def __init__(self, filename, mmap=False, header_only=False, fileobj=None):
+        """ \arg filename should be a valid path to a omicron flat file, or to
+            a file in a zip or tar archive, e.g. data.tar.gz/run/file.Z_flat.
+            \arg mmap if True, the raw data are not read but mapped from the
+            file, the transfer function is only applied to the accessed
+            slices of the DataArray (see MappedData). Ignored for the files
+            of an archive.
+            \arg header_only if True, the raw data are skipped without being
+            decoded, all the other sections of the file are parsed and the
+            DataArray are created with their info but no data.
+            \arg fileobj if given, the file is read from this file object,
+            e.g. a member of iter_archive(), and filename only names it.
+        """
 
         self.filename = filename
+        # Files read from an archive or a file object cannot be mapped nor
+        # cached, their size and modification time are unknown.
+        self.archived = fileobj is not None or \
+                        not os.path.isfile(os.path.normpath(filename))
+        self.fileobj = fileobj
+        self.mmap = mmap and not self.archived
+        self.headerOnly = header_only
         self.data = [] # List containing data of DataArray type
 
         # Define the keys in dictionary since they are version dependant
@@ -122,7 +918,22 @@ class FlatFile():
         # Use V3.0 as fall-back value since it worked out up to V3.1
         self.axis_keys['fall-back'] = self.axis_keys['MATRIX V3.0']
 
-        self.openFlatFile()
+        # Time, bytes read and read calls of each parsed section, filled if
+        # profiling is enabled, see enable_profiling()
+        self.profile = OrderedDict()
+
+        # The mapped data are read from the file itself, so they are never
+        # taken from the disk cache.
+        if diskCache is None or self.mmap or self.archived or \
+           not self._readCache():
+            self.openFlatFile()
+            if diskCache is not None and \
+               not (self.mmap or self.headerOnly or self.archived):
+                with self._section('cacheWrite'):
+                    self._writeCache()
+
+        if profiling and profileHook is not None:
+            profileHook(self)
 
     def openFlatFile(self):
         """ Parse flatFile and create the data array with physical meaning
@@ -130,16 +941,81 @@ class FlatFile():
         """
 
         # Open and read with binary flag
-        self.file = open(os.path.normpath(self.filename), 'rb')
+        if self.fileobj is not None:
+            self.file = self.fileobj
+        else:
+            self.file = _openFile(self.filename)[0]
+        self.cursor = _Cursor(self.file)
+
+        with self._section('header'):
+            self._readHeader()
+        with self._section('data'):
+            self._readData()
+        with self._section('trailer'):
+            self._readTrailer()
+        with self._section('experimentElement'):
+            self._readExperimentElement()
+        with self._section('experimentDeployement'):
+            self._readExperimentDeployement()
+
+        if self.fileobj is None:
+            self.file.close()
+        self.file = None # Explicitly delete the file object
+        self.fileobj = None
+        self.cursor = None
+
+        if self.mmap and not self.headerOnly :
+            self.rawData = memmap(os.path.normpath(self.filename), dtype='<i4',
+                                  mode='r', offset=self.dataOffset,
+                                  shape=(self.dataItemSize,))
+
+        # Deal with the real stuff, try to reconstruct the real data shape from
+        # the raw data.
+        with self._section('reshape'):
+            self._reshapeData()
+
+    @contextmanager
+    def _section(self, name):
+        """ Record the wall time, bytes read and file.read() calls of a
+            section in self.profile if profiling is enabled. The errors of
+            a corrupt file are located in the section. """
+
+        def counters():
+            if self.cursor is None:
+                return 0, 0
+            return self.cursor.bytesRead, self.cursor.readCount
+
+        if profiling:
+            bytesRead, readCount = counters()
+            start = time.time()
+        try:
+            yield
+        except CorruptFileError, error:
+            error.locate(self.filename, name)
+            raise
+        finally:
+            if profiling:
+                bytesEnd, readEnd = counters()
+                self.profile[name] = {'time': time.time() - start,
+                                      'bytes': bytesEnd - bytesRead,
+                                      'reads': readEnd - readCount}
+
+
+    def _readHeader(self):
+        """ Parse the sections of the file preceding the raw data, up to the
+            size of the data. """
 
         #
         # Check Magic word and version
         #
-        if 'FLAT' != unpack( '<4s', self.file.read(4) )[0] : # Magic word
-            raise
+        if 'FLAT' != self.cursor.read(4) : # Magic word
+            raise CorruptFileError(self.filename, 'header', 0,
+                                   'Not a flat file')
 
-        if '0100' != unpack( '<4s', self.file.read(4) )[0] : # Version
-            raise
+        version = self.cursor.read(4)
+        if '0100' != version : # Version
+            raise CorruptFileError(self.filename, 'header', 4,
+                                   'Unhandled version %r' % version)
 
         #
         # Axis Hierarchy Description :
@@ -237,12 +1113,11 @@ class FlatFile():
             paramerterName = self._readString()
             parameters[paramerterName] = self._readDouble()
 
-        if 'TFF_Linear1D' == transferFunctionName :
-            transferFunction = lambda z: ( z - parameters['Offset'] ) / parameters['Factor']
-        elif 'TFF_MultiLinear1D' == transferFunctionName :
-            transferFunction = lambda z: ( parameters['Raw_1'] - parameters['PreOffset'] ) * ( z - parameters['Offset'] ) / parameters['NeutralFactor'] / parameters['PreFactor']
-        else :
-            raise UnhandledTransferFunction
+        if transferFunctionName not in ('TFF_Linear1D', 'TFF_MultiLinear1D') :
+            raise UnhandledTransferFunction, \
+                'Unknown transfer function %s in %s' % (transferFunctionName, self.filename)
+
+        self.transferFunction = TransferFunction(transferFunctionName, parameters)
 
         # Number of data views
         # -> Possible data view types :
@@ -265,7 +1140,7 @@ class FlatFile():
         #
         self.creationInformation = {}
 
-        self.creationInformation['timestamp'] = unpack( '<q', self.file.read(8) )[0]
+        self.creationInformation['timestamp'] = self.cursor.readLong()
         self.creationInformation['date'] = datetime.datetime.fromtimestamp( float(self.creationInformation['timestamp']) ).isoformat(' ')
         self.creationInformation['comment'] = self._readString() ## Added by TGG
 
@@ -280,14 +1155,40 @@ class FlatFile():
         # Actual number of data elements measured
         self.dataItemSize = self._readInt()
 
-        # Raw data array
-        self.rawData = []
+        # Position of the raw data in the file
+        self.dataOffset = self.cursor.tell()
 
-        for i in range(self.dataItemSize) :
-            self.rawData.append( transferFunction(self._readInt()) )
-        # The void pixels will be automatically filled with 0
-        # when using array.resize() with a bigger size than its actual size
-        # This is done in self.reshapeData()
+    def _readData(self):
+        """ Read or skip the raw data """
+
+        if self.headerOnly :
+            self.cursor.skip(4 * self.dataItemSize)
+            self.rawData = self._placeholderData()
+        elif self.mmap and 0 < self.dataItemSize == self.brickletSize :
+            # Raw data are mapped once the file is parsed
+            self.cursor.skip(4 * self.dataItemSize)
+            self.rawData = None
+        else :
+            if self.mmap :
+                print 'WARNING: %s is incomplete and cannot be mapped,' \
+                        % self.filename
+                print 'the data are loaded in memory.'
+                self.mmap = False
+
+            # Raw data counts array of the expected size, the void pixels of
+            # incomplete files are filled with 0. The data are read by blocks
+            # of little endian 32 bits integers, so only one copy of the data
+            # is ever held in memory. They are converted to physical values by
+            # the DataArray when needed.
+            self.rawData = zeros(max(self.brickletSize, self.dataItemSize),
+                                 dtype='<i4')
+
+            for start in range(0, self.dataItemSize, DATA_BLOCK_SIZE) :
+                count = min(DATA_BLOCK_SIZE, self.dataItemSize - start)
+                self.rawData[start:start+count] = self._readIntArray(count)
+
+    def _readTrailer(self):
+        """ Parse the sections of the file following the raw data """
 
         #
         # Sample position information
@@ -332,105 +1233,193 @@ class FlatFile():
             print 'dictionary in the source code.'
             self.axis_keys = self.axis_keys['fall-back']
 
+    def _readExperimentElement(self):
+        """ Parse the experiment element parameter list """
+
         #
         # Experiment Element Parameter List
         #
-        elementsCount = self._readInt()
-
-        self.experimentElement = {}
+        # These sections hold thousands of values, the cursor methods are
+        # bound once to limit the cost of each call.
+        readString = self.cursor.readString
+        readInt = self.cursor.readInt
+        skipString = self.cursor.skipString
 
-        for i in range(elementsCount) :
+        # The parameters are only indexed here, each element is decoded
+        # when first accessed, see ParameterSection. The section is read up
+        # to the end of the file, so it stays in the cursor buffer.
+        self.cursor.loadRemaining()
+        start = self.cursor.position
 
-            instanceName = self._readString()
-            self.experimentElement[instanceName] = {}
+        index = {}
+        for i in range(readInt()) :
 
-            parameterCount = self._readInt()
+            instanceName = readString()
+            parameterCount = readInt()
+            index[instanceName] = (self.cursor.position - start, parameterCount)
 
             for j in range(parameterCount) :
 
-                parameterName = self._readString()
-                parameterTypeCode = self._readInt()
-                parameterUnit = self._readString()
-                parameterValue = self._readString()
-
-                # Every value is passed as a string but can
-                # represent different object type according
-                # to the given parameter type code
-                if parameterTypeCode == 1 :   # 32bits integer
-                    parameterValue = int(parameterValue)
-                elif parameterTypeCode == 2 : # Double precision float
-                    parameterValue = float(parameterValue)
-                elif parameterTypeCode == 3 : # Boolean
-                    if parameterValue == 'true' :
-                        parameterValue = True
-                    else :
-                        parameterValue = False
-                elif parameterTypeCode == 4 : # Enum
-                    parameterValue = parameterValue # FIXME unhandled, since never used
-                elif parameterTypeCode == 5 : # Unicode character string
-                    parameterValue = parameterValue
-                else :
+                skipString() # parameter name
+                parameterTypeCode = readInt()
+                if not 1 <= parameterTypeCode <= 5 :
                     raise ParameterTypeError, 'Unknown parameter type %i given' % parameterTypeCode
+                skipString() # parameter unit
+                skipString() # parameter value
+
+        self.experimentElement = ParameterSection(
+            self.cursor.buffer[start:self.cursor.position], index,
+            _decodeElementParameters)
 
-                self.experimentElement[instanceName][parameterName] = {
-                    'value': parameterValue,
-                    'unit' : parameterUnit
-                    }
-                # Note: parameterUnit can be = u'--' which means no unit.
+    def _readExperimentDeployement(self):
+        """ Parse the deployment parameters, the last section of the file """
+
+        readString = self.cursor.readString
+        readInt = self.cursor.readInt
+        skipString = self.cursor.skipString
 
         #
         # Deployement parameters
         #
-        elementsCount = self._readInt()
-
-        self.experimentDeployement = {}
-
-        for i in range(elementsCount) :
+        # Indexed as the experiment element parameters
+        start = self.cursor.position
 
-            instanceName = self._readString()
-            deploymentCount = self._readInt()
+        index = {}
+        for i in range(readInt()) :
 
-            self.experimentDeployement[instanceName] = {}
+            instanceName = readString()
+            deploymentCount = readInt()
+            index[instanceName] = (self.cursor.position - start, deploymentCount)
 
             for j in range(deploymentCount) :
+                skipString()
+                skipString()
 
-                 self.experimentDeployement[instanceName][self._readString()] = self._readString()
+        self.experimentDeployement = ParameterSection(
+            self.cursor.buffer[start:self.cursor.position], index,
+            _decodeDeployement)
 
-        assert self.file.read() == '', 'There are still some unknown informations at the end of the file %s ' % self.filename
-
-        self.file.close()
-        self.file = None # Explicitly delete the file object
-
-        # Deal with the real stuff, try to reconstruct the real data shape from
-        # the raw data.
-        self._reshapeData()
+        remaining = self.cursor.readRemaining()
+        if remaining :
+            raise CorruptFileError(self.filename, 'experimentDeployement',
+                                   self.cursor.tell() - len(remaining),
+                                   '%i unknown bytes at the end of the file' % len(remaining))
 
 
     def _readString( self ) :
         """Read a Omicron string in the open file. The string are stored as UTF-16 characters preceded with an integer corresponding to the length of the string """
 
-        length = unpack( '<i', self.file.read(4) )[0]
-        if length :
-            return unicode( self.file.read( 2 * length ) ,'utf16', 'replace' ) # 16 bits unicode character
-        else :
-            return None
+        return self.cursor.readString()
 
 
     def _readInt( self ) :
         """Unpack an integer from the bytestream """
 
-        return unpack( '<i', self.file.read(4) )[0]
+        return self.cursor.readInt()
+
+
+    def _readIntArray( self, count ) :
+        """Unpack count integers from the bytestream into a numpy array """
+
+        return self.cursor.readIntArray(count)
 
 
     def _readDouble( self ) :
         """Unpack a double from the bytestream """
 
-        return unpack( '<d', self.file.read(8) )[0]
+        return self.cursor.readDouble()
+
+    def _placeholderData(self):
+        """Return a zero strided array with the size of the data, used to
+           build the DataArray info without any memory cost. """
+
+        return as_strided(zeros(1, dtype='<i4'),
+                          shape=(self.brickletSize,), strides=(0,))
+
+    def _readCache(self):
+        """Restore the parsed file from the disk cache. Return False if there
+           is no valid cache entry. """
+
+        try:
+            with self._section('cacheRead'):
+                entry = diskCache.get(self.filename,
+                                      load_data=not self.headerOnly)
+        except OSError: # e.g. missing file, reported by openFlatFile
+            return False
+        if entry is None:
+            return False
+
+        state, self.rawData = entry
+        for name in CACHED_ATTRIBUTES:
+            setattr(self, name, state[name])
+        if self.headerOnly:
+            self.rawData = self._placeholderData()
+
+        with self._section('reshape'):
+            self._reshapeData()
+        return True
+
+    def __getstate__(self):
+        """Pickle the parsed sections and the data as a single flat array,
+           the scan directions are views rebuilt when unpickled. """
+
+        state = dict((name, getattr(self, name)) for name in CACHED_ATTRIBUTES)
+        state['filename'] = self.filename
+        state['headerOnly'] = self.headerOnly
+        state['archived'] = self.archived
+        state['mmap'] = False # Mapped data are pickled as in memory counts
+        state['profile'] = self.profile
+
+        if self.headerOnly:
+            state['rawData'] = None
+        elif self.mmap:
+            state['rawData'] = asarray(self.rawData).ravel()
+        else:
+            state['rawData'] = ravel(self.rawData)
+        return state
+
+    def __setstate__(self, state):
+        rawData = state.pop('rawData')
+        self.__dict__.update(state)
+        self.file = None
+        self.fileobj = None
+        self.cursor = None
+        self.data = []
+
+        if self.headerOnly:
+            self.rawData = self._placeholderData()
+        else:
+            self.rawData = rawData
+        self._reshapeData()
+
+    def _writeCache(self):
+        """Store the parsed file in the disk cache """
+
+        state = dict((name, getattr(self, name)) for name in CACHED_ATTRIBUTES)
+        try:
+            diskCache.put(self.filename, state, ravel(self.rawData))
+        except (IOError, OSError), error:
+            print 'WARNING: Unable to cache %s: %s' % (self.filename, error)
+
+    def _flatData(self, size):
+        """Return the rawData as a flat array of the given size. As with
+           numpy.resize(), missing values are filled with 0. """
+
+        if self.rawData.shape[0] != size :
+            rawData = zeros(size, dtype=self.rawData.dtype)
+            count = min(size, self.rawData.shape[0])
+            rawData[:count] = self.rawData[:count]
+            self.rawData = rawData
+
+        return self.rawData
 
     def _reshapeData(self):
-        """Create a data dictionary from the rawData according to the file parameters """
+        """Create a data dictionary from the rawData according to the file parameters
+
+           Each scan direction is a view of the rawData counts array, no copy
+           of the data is done.
+        """
 
-        self.rawData = array(self.rawData) # Convert data list to a numpy array
 
         # common info for all type of files
         info = {'filename' : self.filename,
@@ -463,46 +1452,38 @@ class FlatFile():
                 'unitxy' : 'nm',
                 })
 
-            self.rawData.resize( sizeY*(self.axis[self.axis_keys['Y']]['mirrored']+1), sizeX*(self.axis[self.axis_keys['X']]['mirrored']+1) )
+            shape = ( sizeY*(self.axis[self.axis_keys['Y']]['mirrored']+1), sizeX*(self.axis[self.axis_keys['X']]['mirrored']+1) )
+            self.rawData = self._flatData(shape[0]*shape[1]).reshape(shape)
 
             # Both axis are mirrored
             # 4 images : up-fwd, up-bwd, down-fwd, down-bwd
             # Note on array syntax [start:stop:increment]
             if self.axis[self.axis_keys['X']]['mirrored'] and self.axis[self.axis_keys['Y']]['mirrored'] :
-                info['direction'] = 'up-fwd'
-                self.data.append(DataArray(self.rawData[ 0:sizeY, 0:sizeX], info))
-                info['direction'] = 'up-bwd'
-                self.data.append(DataArray(self.rawData[ 0:sizeY, :sizeX-1:-1 ], info))
-                info['direction'] = 'down-fwd'
-                self.data.append(DataArray(self.rawData[ :sizeY-1:-1, 0:sizeX], info))
-                info['direction'] = 'down-bwd'
-                self.data.append(DataArray( self.rawData[ :sizeY-1:-1, :sizeX-1:-1], info))
+                self.data.append(DataArray(self.rawData[ 0:sizeY, 0:sizeX], info, 'up-fwd', self.transferFunction))
+                self.data.append(DataArray(self.rawData[ 0:sizeY, :sizeX-1:-1 ], info, 'up-bwd', self.transferFunction))
+                self.data.append(DataArray(self.rawData[ :sizeY-1:-1, 0:sizeX], info, 'down-fwd', self.transferFunction))
+                self.data.append(DataArray( self.rawData[ :sizeY-1:-1, :sizeX-1:-1], info, 'down-bwd', self.transferFunction))
 
             # Only X is mirrored
             # 2 images up : fwd and bwd
             elif self.axis[self.axis_keys['X']]['mirrored'] :
                 if DEBUG : print 'Only X is mirrored'
-                info['direction'] = 'up-fwd'
-                self.data.append(DataArray(self.rawData[ :,0:sizeX], info))
-                info['direction'] = 'up-bwd'
-                self.data.append(DataArray(self.rawData[ :,:sizeX-1:-1], info))
+                self.data.append(DataArray(self.rawData[ :,0:sizeX], info, 'up-fwd', self.transferFunction))
+                self.data.append(DataArray(self.rawData[ :,:sizeX-1:-1], info, 'up-bwd', self.transferFunction))
 
             # Only Y is mirrored
             # 2 images fwd : up and down
             elif self.axis[self.axis_keys['Y']]['mirrored'] :
-                info['direction'] = 'up-fwd'
-                self.data.append(DataArray(self.rawData[ 0:sizeY,:], info))
-                info['direction'] = 'down-fwd'
-                self.data.append(DataArray(self.rawData[ :sizeY-1:-1,:], info))
+                self.data.append(DataArray(self.rawData[ 0:sizeY,:], info, 'up-fwd', self.transferFunction))
+                self.data.append(DataArray(self.rawData[ :sizeY-1:-1,:], info, 'down-fwd', self.transferFunction))
 
             # Only one image
             else :
-                info['direction'] = 'up-fwd'
-                self.data.append(DataArray(self.rawData, info))
+                self.data.append(DataArray(self.rawData, info, 'up-fwd', self.transferFunction))
 
         elif self.isVPointSpectroscopy():
 
-            sizeV = self.axis[self.axis_keys['V']]['clockCount']/(self.axis[self.axis_keys['V']]['mirrored']+1)
+            sizeV = int(self.axis[self.axis_keys['V']]['clockCount']/(self.axis[self.axis_keys['V']]['mirrored']+1))
 
             info.update({
                 'type' : 'ivcurve',
@@ -513,11 +1494,9 @@ class FlatFile():
                 'unitv' : self.axis[self.axis_keys['V']]['unit'],
                 })
 
-            info['direction'] = 'fwd'
-            self.data.append(DataArray(self.rawData[:sizeV], info))
+            self.data.append(DataArray(self.rawData[:sizeV], info, 'fwd', self.transferFunction))
             if self.axis[self.axis_keys['V']]['mirrored']:
-                info['direction'] = 'bwd'
-                self.data.append(DataArray(self.rawData[:sizeV-1:-1], info))
+                self.data.append(DataArray(self.rawData[:sizeV-1:-1], info, 'bwd', self.transferFunction))
 
         elif self.isZPointSpectroscopy():
             # FIXME Implement izcurve
@@ -537,7 +1516,7 @@ class FlatFile():
             sizeY = (infoY['stop']-infoY['start'])//infoY['step']+1
 
             mirroredV = self.axis[self.axis_keys['V']]['mirrored']
-            sizeV = self.axis[self.axis_keys['V']]['clockCount']/(mirroredV+1)
+            sizeV = int(self.axis[self.axis_keys['V']]['clockCount']/(mirroredV+1))
 
             # Find out if I(V) are measured on bwd and fwd scan (==mirrored)
             mirroredX = len(self.axis[self.axis_keys['V']]['tableSets'][self.axis_keys['X']])==2
@@ -562,23 +1541,24 @@ class FlatFile():
                 'vreal' : sizeV * self.axis[self.axis_keys['V']]['incrementPhysical'],
                 'unitv' : self.axis[self.axis_keys['V']]['unit'],
             })
-            dataTemp = copy(self.rawData) # FIXME copy() .... this has huge memory impact
-            dataTemp.resize( sizeX*(mirroredX+1)*sizeY*(mirroredY+1),
-                             sizeV*(mirroredV+1) ) # each line is a spect. curve
-            dataTemp = transpose(dataTemp) # each column is a spectroscopy curve
+            shape = ( sizeY*(mirroredY+1),
+                      sizeX*(mirroredX+1),
+                      sizeV*(mirroredV+1) )
 
-            # Cut Matrix in two if data are mirrored
-            if mirroredV:
-                dataTempMirrored = copy(dataTemp[:sizeV-1:-1,:]) # Reverse order of mirrored data
-                dataTemp = copy(dataTemp[:sizeV,:])
+            # The spectroscopy curves are contiguous in the raw data, view them
+            # as cols,rows,V and put V first, this is a strided view and not a
+            # copy of the data.
+            self.rawData = self._flatData(shape[0]*shape[1]*shape[2]).reshape(shape)
+            dataTemp = self.rawData.transpose(2, 0, 1) # slices,cols,rows : 3D view
+
+            # Layout of the raw data, see readSlice() and readSpectrum()
+            self.gridShape = shape
+            self.gridSize = (sizeY, sizeX, sizeV)
 
-            dataTemp = resize(dataTemp, ( sizeV,
-                             sizeY*(mirroredY+1),
-                             sizeX*(mirroredX+1))) # slices,cols,rows : 3D view
+            # Cut Matrix in two if data are mirrored
             if mirroredV:
-                dataTempMirrored.resize(sizeV,
-                                        sizeY*(mirroredY+1),
-                                        sizeX*(mirroredX+1) )     # slices,cols,rows : 3D view
+                dataTempMirrored = dataTemp[:sizeV-1:-1] # Reverse order of mirrored data
+                dataTemp = dataTemp[:sizeV]
 
             self.data = []
 
@@ -587,74 +1567,80 @@ class FlatFile():
             # Note on array syntax [start:stop:increment]
             if mirroredX and mirroredY :
                 if DEBUG : print 'X and Y mirrored'
-                info['direction'] = 'up-fwd'
-                self.data.append(DataArray(dataTemp[ :, 0:sizeY, 0:sizeX], info))
-                info['direction'] = 'up-bwd'
-                self.data.append(DataArray(dataTemp[ :, 0:sizeY, :sizeX-1:-1 ], info))
-                info['direction'] = 'down-fwd'
-                self.data.append(DataArray(dataTemp[ :, :sizeY-1:-1, 0:sizeX], info))
-                info['direction'] = 'down-bwd'
-                self.data.append(DataArray(dataTemp[ :, :sizeY-1:-1, :sizeX-1:-1], info))
+                self.data.append(DataArray(dataTemp[ :, 0:sizeY, 0:sizeX], info, 'up-fwd', self.transferFunction))
+                self.data.append(DataArray(dataTemp[ :, 0:sizeY, :sizeX-1:-1 ], info, 'up-bwd', self.transferFunction))
+                self.data.append(DataArray(dataTemp[ :, :sizeY-1:-1, 0:sizeX], info, 'down-fwd', self.transferFunction))
+                self.data.append(DataArray(dataTemp[ :, :sizeY-1:-1, :sizeX-1:-1], info, 'down-bwd', self.transferFunction))
 
                 if mirroredV:
                     if DEBUG : print 'V mirrored'
-                    info['direction'] = 'up-fwd mirrored'
-                    self.data.append(DataArray(dataTempMirrored[ :, 0:sizeY, 0:sizeX], info))
-                    info['direction'] = 'up-bwd mirrored'
-                    self.data.append(DataArray(dataTempMirrored[ :, 0:sizeY, :sizeX-1:-1 ], info))
-                    info['direction'] = 'down-fwd mirrored'
-                    self.data.append(DataArray(dataTempMirrored[ :, :sizeY-1:-1, 0:sizeX], info))
-                    info['direction'] = 'down-bwd mirrored'
-                    self.data.append(DataArray(dataTempMirrored[ :, :sizeY-1:-1, :sizeX-1:-1], info))
+                    self.data.append(DataArray(dataTempMirrored[ :, 0:sizeY, 0:sizeX], info, 'up-fwd mirrored', self.transferFunction))
+                    self.data.append(DataArray(dataTempMirrored[ :, 0:sizeY, :sizeX-1:-1 ], info, 'up-bwd mirrored', self.transferFunction))
+                    self.data.append(DataArray(dataTempMirrored[ :, :sizeY-1:-1, 0:sizeX], info, 'down-fwd mirrored', self.transferFunction))
+                    self.data.append(DataArray(dataTempMirrored[ :, :sizeY-1:-1, :sizeX-1:-1], info, 'down-bwd mirrored', self.transferFunction))
 
             # Only X is mirrored
             # 2 images up : fwd and bwd
             elif mirroredX:
                 if DEBUG : print 'X mirrored only'
-                info['direction'] = 'up-fwd'
-                self.data.append(DataArray(dataTemp[ :, :, 0:sizeX ], info))
-                info['direction'] = 'up-bwd'
-                self.data.append(DataArray(dataTemp[ :, :, :sizeX-1:-1 ], info))
+                self.data.append(DataArray(dataTemp[ :, :, 0:sizeX ], info, 'up-fwd', self.transferFunction))
+                self.data.append(DataArray(dataTemp[ :, :, :sizeX-1:-1 ], info, 'up-bwd', self.transferFunction))
 
                 if mirroredV:
                     if DEBUG : print 'V mirrored'
-                    info['direction'] = 'up-fwd mirrored'
-                    self.data.append(DataArray(dataTempMirrored[ :, :, 0:sizeX ], info))
-                    info['direction'] = 'up-bwd mirrored'
-                    self.data.append(DataArray(dataTempMirrored[ :, :, :sizeX-1:-1 ], info))
+                    self.data.append(DataArray(dataTempMirrored[ :, :, 0:sizeX ], info, 'up-fwd mirrored', self.transferFunction))
+                    self.data.append(DataArray(dataTempMirrored[ :, :, :sizeX-1:-1 ], info, 'up-bwd mirrored', self.transferFunction))
 
             # Only Y is mirrored
             # 2 images fwd : up and down
             elif mirroredY:
                 if DEBUG : print 'Y mirrored only'
-                info['direction'] = 'up-fwd'
-                self.data.append(DataArray(dataTemp[ :, 0:sizeY,:], info))
-                info['direction'] = 'down-fwd'
-                self.data.append(DataArray(dataTemp[ :, :sizeY-1:-1,:], info))
+                self.data.append(DataArray(dataTemp[ :, 0:sizeY,:], info, 'up-fwd', self.transferFunction))
+                self.data.append(DataArray(dataTemp[ :, :sizeY-1:-1,:], info, 'down-fwd', self.transferFunction))
 
                 if mirroredV:
                     if DEBUG : print 'V mirrored'
-                    info['direction'] = 'up-fwd mirrored'
-                    self.data.append(DataArray(dataTempMirrored[ :, 0:sizeY,:], info))
-                    info['direction'] = 'down-fwd mirrored'
-                    self.data.append(DataArray(dataTempMirrored[ :, :sizeY-1:-1,:], info))
+                    self.data.append(DataArray(dataTempMirrored[ :, 0:sizeY,:], info, 'up-fwd mirrored', self.transferFunction))
+                    self.data.append(DataArray(dataTempMirrored[ :, :sizeY-1:-1,:], info, 'down-fwd mirrored', self.transferFunction))
 
             # Only one image
             else:
                 if DEBUG : print 'X, Y not mirrored'
-                info['direction'] = 'up-fwd'
-                self.data.append(DataArray(dataTemp, info))
+                self.data.append(DataArray(dataTemp, info, 'up-fwd', self.transferFunction))
 
                 if mirroredV:
                     if DEBUG : print 'V mirrored'
-                    info['direction'] = 'up-fwd mirrored'
-                    self.data.append(DataArray(dataTempMirrored, info))
+                    self.data.append(DataArray(dataTempMirrored, info, 'up-fwd mirrored', self.transferFunction))
 
         else :
             if DEBUG:
                 print self.axis
             raise UnhandledDataType, "The data file %s has an unhandled type." % self.filename
 
+        if self.headerOnly :
+            self.rawData = None
+            for dataArray in self.data :
+                dataArray.counts = None
+        elif self.mmap :
+            # Raw data counts are only converted when accessed
+            for dataArray in self.data :
+                dataArray.data = MappedData(dataArray.counts, self.transferFunction)
+        elif self.dataItemSize < self.rawData.size :
+            # The void pixels of incomplete files are 0 in physical values
+            valid = arange(self.rawData.size) < self.dataItemSize
+            for dataArray in self.data :
+                dataArray.valid = self._viewLike(valid, dataArray.counts)
+
+    def _viewLike(self, flat, view):
+        """Return the view on the flat array with the same layout as the view
+           on the rawData array. """
+
+        itemsize = self.rawData.itemsize
+        start = (view.__array_interface__['data'][0] -
+                 self.rawData.__array_interface__['data'][0]) // itemsize
+        strides = [stride // itemsize * flat.itemsize for stride in view.strides]
+        return as_strided(flat[start:], shape=view.shape, strides=strides)
+
     def isTopography(self):
         """ Return True if the file represents a topography image with X and Y axes. """
         if self.dimension == 2 and self.axis_keys['X'] in self.axis and self.axis_keys['Y'] in self.axis:
@@ -695,12 +1681,573 @@ class FlatFile():
 
         return self.data
 
-def load(filename):
+    def readSlice(self, direction, vIndex):
+        """Return the physical values of the slice vIndex of the given scan
+           direction of a grid spectroscopy, as a (y, x) array.
+
+           Only the values of the slice are read, so the file can be opened
+           with header_only=True to browse a large or remote grid.
+        """
+
+        sizeY, sizeX, sizeV = self._gridCheck(direction, vIndex=vIndex)
+        index = self._gridIndex(direction, arange(sizeY), arange(sizeX), vIndex)
+        return self._readCounts(index[:, :, 0])
+
+    def readSpectrum(self, direction, x, y):
+        """Return the physical values of the spectrum measured at the pixel
+           x, y of the given scan direction of a grid spectroscopy.
+
+           Only the values of the spectrum are read, see readSlice().
+        """
+
+        sizeY, sizeX, sizeV = self._gridCheck(direction, x=x, y=y)
+        index = self._gridIndex(direction, y, x, arange(sizeV))
+        return self._readCounts(index[0, 0, :])
+
+    def iterSlices(self, direction, count=None):
+        """Iterate over the given scan direction of a grid spectroscopy by
+           blocks of count voltage slices.
+
+           Yield (key, data) with data the physical values of the block and
+           key its index in the (v, y, x) cube of the direction, i.e.
+           cube[key] == data. Only one block is held in memory at once, the
+           default count gives blocks of about CHUNK_SIZE values. As with
+           readSlice(), the values are read from the file if they are not
+           loaded. A file in an archive can only be decompressed forward
+           from its start, its data are then read once for the whole
+           iteration and held in memory instead.
+        """
+
+        sizeY, sizeX, sizeV = self._gridCheck(direction)
+        count = count or max(1, CHUNK_SIZE // (sizeY * sizeX))
+        return self._iterBlocks(direction,
+            ((slice(v, min(v + count, sizeV)), slice(None), slice(None))
+             for v in range(0, sizeV, count)))
+
+    def iterTiles(self, direction, size=None):
+        """Iterate over the given scan direction of a grid spectroscopy by
+           square tiles of size x size pixels holding all their spectra, see
+           iterSlices(). """
+
+        sizeY, sizeX, sizeV = self._gridCheck(direction)
+        size = size or max(1, int(sqrt(CHUNK_SIZE // sizeV)))
+        return self._iterBlocks(direction,
+            ((slice(None), slice(y, min(y + size, sizeY)),
+              slice(x, min(x + size, sizeX)))
+             for y in range(0, sizeY, size) for x in range(0, sizeX, size)))
+
+    def iterSpectra(self, direction, count=None):
+        """Iterate over the given scan direction of a grid spectroscopy by
+           blocks of count lines of spectra, see iterSlices(). The spectra
+           are contiguous in the file, so this is the fastest way to read a
+           grid which is not loaded. """
+
+        sizeY, sizeX, sizeV = self._gridCheck(direction)
+        count = count or max(1, CHUNK_SIZE // (sizeX * sizeV))
+        return self._iterBlocks(direction,
+            ((slice(None), slice(y, min(y + count, sizeY)), slice(None))
+             for y in range(0, sizeY, count)))
+
+    def _iterBlocks(self, direction, keys):
+        """Yield (key, data) for the blocks keys of the scan direction. The
+           data of a file in an archive, not loaded, are read once here
+           rather than decompressed again up to each block. """
+
+        counts = None
+        if self.rawData is None and self.archived and self.dataItemSize > 0:
+            with _opened(self.filename) as (dataFile, size):
+                dataFile.seek(self.dataOffset)
+                counts = frombuffer(dataFile.read(4 * self.dataItemSize),
+                                    dtype='<i4')
+        for key in keys:
+            yield key, self._readBlock(direction, key, counts)
+
+    def _readBlock(self, direction, key, counts=None):
+        """Return the physical values of the block key of the (v, y, x)
+           cube of the scan direction, read from the flat array of counts if
+           given """
+
+        sizeY, sizeX, sizeV = self.gridSize
+        v, y, x = [arange(size)[k] for k, size in zip(key, (sizeV, sizeY, sizeX))]
+        index = self._gridIndex(direction, y, x, v)
+        return self._readCounts(index, counts).transpose(2, 0, 1)
+
+    def _gridCheck(self, direction, x=0, y=0, vIndex=0):
+        """Check the arguments of a partial read, return the grid size """
+
+        if not self.isGridSpectroscopy():
+            raise UnhandledDataType, \
+                "The data file %s is not a grid spectroscopy." % self.filename
+        if direction not in [dataArray.direction for dataArray in self.data]:
+            raise OutOfBoundError, "No %s scan direction in %s" % \
+                    (direction, self.filename)
+
+        sizeY, sizeX, sizeV = self.gridSize
+        if not (0 <= x < sizeX and 0 <= y < sizeY and 0 <= vIndex < sizeV):
+            raise OutOfBoundError, "Point x=%i, y=%i, v=%i out of %ix%ix%i" % \
+                    (x, y, vIndex, sizeX, sizeY, sizeV)
+        return sizeY, sizeX, sizeV
+
+    def _gridIndex(self, direction, y, x, v):
+        """Return the raw data index of the points y, x, v (integers or
+           arrays) of the scan direction, as a 3D array broadcasted in the
+           order y, x, v.
+
+           The raw data are stored as rows, cols, V and the bwd, down and
+           mirrored directions count from the end of their axis.
+        """
+
+        shapeY, shapeX, shapeV = self.gridShape
+        if 'down' in direction:
+            y = shapeY - 1 - y
+        if 'bwd' in direction:
+            x = shapeX - 1 - x
+        if 'mirrored' in direction:
+            v = shapeV - 1 - v
+
+        y, x, v = ix_(*[atleast_1d(i) for i in (y, x, v)])
+        return (y * shapeX + x) * shapeV + v
+
+    def _readCounts(self, index, rawData=None):
+        """Return the physical values of the raw data at index, the counts
+           are read from rawData if given, from memory if loaded, else from
+           the file. The void pixels of incomplete files are 0. """
+
+        valid = index < self.dataItemSize
+        counts = zeros(index.shape, dtype='<i4')
+
+        if rawData is None:
+            rawData = self.rawData
+        if rawData is not None:
+            counts[valid] = rawData.reshape(-1)[index[valid]]
+        elif self.dataItemSize > 0 and self.archived:
+            # Archive members cannot be mapped, their data are read up to the
+            # last value needed.
+            with _opened(self.filename) as (dataFile, size):
+                dataFile.seek(self.dataOffset)
+                count = int(index[valid].max()) + 1 if valid.any() else 0
+                mapped = frombuffer(dataFile.read(4 * count), dtype='<i4')
+            counts[valid] = mapped[index[valid]]
+        elif self.dataItemSize > 0:
+            mapped = memmap(os.path.normpath(self.filename), dtype='<i4',
+                            mode='r', offset=self.dataOffset,
+                            shape=(self.dataItemSize,))
+            counts[valid] = mapped[index[valid]]
+            del mapped
+
+        data = self.transferFunction(counts)
+        data[~valid] = 0
+        return data
+
+class FlatFileStream(FlatFile):
+    """Incremental reader of a flat file still being written by Matrix
+       during the acquisition.
+
+       The header is parsed once, then each call to poll() reads only the
+       values measured since the previous call, up to the size of the data
+       written in the file header and the size of the file. The sections
+       following the data are not parsed, so no DataArray is created.
+    """
+
+    def __init__(self, filename):
+        FlatFile.__init__(self, filename, header_only=True)
+
+    def _readCache(self):
+        return False # The file is changing
+
+    def _writeCache(self):
+        pass
+
+    def openFlatFile(self):
+        """ Parse the header of the file and find out the size of the
+            measurement units: the lines of a topography, the spectra of a
+            grid spectroscopy or the points of a spectroscopy curve.
+        """
+
+        self.file = open(os.path.normpath(self.filename), 'rb')
+        self.cursor = _Cursor(self.file)
+        with self._section('header'):
+            self._readHeader()
+        self.file.close()
+        self.file = None
+        self.cursor = None
+
+        # The Matrix version is only given after the data, select the axis
+        # keys from the axis names instead.
+        for version in ('MATRIX V3.1-1', 'MATRIX V3.0') :
+            if set(self.axis_keys[version].values()) & set(self.axis) :
+                self.axis_keys = self.axis_keys[version]
+                break
+        else :
+            self.axis_keys = self.axis_keys['fall-back']
+
+        def size(key) :
+            axis = self.axis[self.axis_keys[key]]
+            return int(axis['clockCount']/(axis['mirrored']+1))*(axis['mirrored']+1)
+
+        if self.isTopography() :
+            self.shape = (size('Y'), size('X'))
+        elif self.isVPointSpectroscopy() :
+            self.shape = (self.brickletSize,)
+        elif self.isGridSpectroscopy() :
+            tableSets = self.axis[self.axis_keys['V']]['tableSets']
+            infoX = tableSets[self.axis_keys['X']][0]
+            infoY = tableSets[self.axis_keys['Y']][0]
+            sizeX = (infoX['stop']-infoX['start'])//infoX['step']+1
+            sizeY = (infoY['stop']-infoY['start'])//infoY['step']+1
+            self.shape = (sizeY*len(tableSets[self.axis_keys['Y']]),
+                          sizeX*len(tableSets[self.axis_keys['X']]),
+                          size('V'))
+        else :
+            raise UnhandledDataType, "The data file %s has an unhandled type." % self.filename
+
+        # Number of values of a measurement unit and number of values read
+        self.unitSize = int(prod(self.unitShape()))
+        self.itemCount = 0
+
+    def poll(self):
+        """Return (start, data) with data the physical values of the units
+           completed since the last call and start the index of the first of
+           them, i.e. the line, the spectrum (counted along the rows) or the
+           point. data has a shape (count,) + unit shape, with count = 0 if
+           nothing new was written.
+        """
+
+        with open(os.path.normpath(self.filename), 'rb') as dataFile :
+            fileSize = os.fstat(dataFile.fileno()).st_size
+            dataFile.seek(self.dataOffset - 4)
+            itemSize = _Cursor.unpackInt(dataFile.read(4))[0]
+
+            available = min(itemSize, self.brickletSize,
+                            (fileSize - self.dataOffset) // 4)
+            end = available - available % self.unitSize
+            start = self.itemCount
+
+            if end > start :
+                dataFile.seek(self.dataOffset + 4 * start)
+                counts = frombuffer(dataFile.read(4 * (end - start)), dtype='<i4')
+                self.itemCount = end
+            else :
+                counts = zeros(0, dtype='<i4')
+
+        return start // self.unitSize, \
+               self.transferFunction(counts).reshape((-1,) + self.unitShape())
+
+    def unitShape(self):
+        """Return the shape of a measurement unit """
+
+        if len(self.shape) == 3 :
+            return self.shape[2:] # A spectrum
+        return self.shape[1:] # A line, or a single point
+
+    def isComplete(self):
+        """Return True once all the expected values have been read """
+
+        return self.itemCount >= self.brickletSize
+
+def load(filename, mmap=False, cache=True):
     """Loader function for further data processing
-    Return a list of DataArray object"""
+    Return a list of DataArray object
+
+    With mmap=True the data are mapped from the file instead of being loaded
+    in memory, see FlatFile. filename can also be the path of a file in a zip
+    or tar archive, e.g. data.zip/run/file.Z_flat, it is read without being
+    extracted and is not cached.
+
+    The loaded files are kept in memoryCache and returned again as long as
+    the file is not modified. Their data are shared between the callers and
+    are therefore read-only, use cache=False to get a private writable copy.
+    The mapped files are not cached, each entry would hold its file open."""
+
+    if mmap or not cache or memoryCache.maxBytes <= 0:
+        return FlatFile(filename, mmap=mmap).getData()
+
+    try:
+        path, size, mtime = flatfile_cache.file_key(filename)
+    except OSError: # e.g. missing file, reported by FlatFile
+        return FlatFile(filename, mmap=mmap).getData()
+
+    data = memoryCache.get(path, (size, mtime))
+    if data is None:
+        ff = FlatFile(filename)
+        data = ff.getData()
+        # The counts and their physical values once converted
+        nbytes = ff.rawData.nbytes + ff.rawData.size * 8
+        for dataArray in data:
+            dataArray.counts.flags.writeable = False
+        memoryCache.put(path, (size, mtime), data, nbytes)
+
+    return list(data)
+
+# In-process cache of load()
+memoryCache = MemoryCache()
+
+def _initWorker(diskCacheConfig, profile):
+    """Set up a load_many() worker process with the disk cache and the
+    profiling of its parent, the profile hook is called by the parent."""
+
+    global diskCache, profiling
+    if diskCacheConfig is None:
+        diskCache = None
+    else:
+        diskCache = flatfile_cache.DiskCache(*diskCacheConfig)
+    profiling = profile
+
+def _loadWorker(filename):
+    # The FlatFile is sent back rather than its DataArray, so the data are
+    # pickled once as a flat array instead of one copy per scan direction.
+    return FlatFile(filename)
+
+def iload_many(filenames, workers=None, chunksize=1):
+    """Load the files in a pool of worker processes and yield their list of
+    DataArray in the order of filenames, as soon as they are available.
+
+    workers is the number of processes, by default the number of CPUs. The
+    data are parsed in the workers and sent back to this process, the memory
+    cache of load() is not used. The pool pays off for many files whose
+    parsing dominates, e.g. spectra with large parameter tables, for big maps
+    sending the data back costs about as much as parsing them.
+    On Windows, the calling script must be protected by an
+    if __name__ == '__main__': block."""
+
+    filenames = list(filenames)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = min(workers, len(filenames))
+
+    if workers <= 1:
+        for filename in filenames:
+            yield load(filename, cache=False)
+        return
+
+    if diskCache is None:
+        diskCacheConfig = None
+    else:
+        diskCacheConfig = (diskCache.directory, diskCache.max_size)
+
+    pool = multiprocessing.Pool(workers, _initWorker,
+                                (diskCacheConfig, profiling))
+    try:
+        for ff in pool.imap(_loadWorker, filenames, chunksize):
+            if profiling and profileHook is not None:
+                profileHook(ff)
+            yield ff.getData()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def load_many(filenames, workers=None, chunksize=1):
+    """Load the files in a pool of worker processes, see iload_many().
+    Return a list of the lists of DataArray in the order of filenames."""
+
+    return list(iload_many(filenames, workers, chunksize))
+
+def enable_disk_cache(directory, max_size=flatfile_cache.DEFAULT_MAX_SIZE):
+    """Keep the parsed files in a persistent cache in directory, bounded to
+    max_size bytes. A file is parsed again only if its size or modification
+    time changed. The files loaded with mmap=True are not cached.
+    Return the flatfile_cache.DiskCache object."""
+
+    global diskCache
+    diskCache = flatfile_cache.DiskCache(directory, max_size)
+    return diskCache
+
+def disable_disk_cache():
+    """Stop using the persistent cache, its entries are kept on disk."""
+
+    global diskCache
+    diskCache = None
+
+def enable_profiling(hook=None):
+    """Record the wall time, bytes read and file.read() calls of each section
+    of the parsed files in the profile dictionary of the FlatFile, e.g.
+    ff.profile['experimentElement']['time']. If given, hook(flatFile) is
+    called once each file is loaded, e.g. to report slow files."""
+
+    global profiling, profileHook
+    profiling = True
+    profileHook = hook
+
+def disable_profiling():
+    """Stop recording the parsing profile of the files."""
+
+    global profiling, profileHook
+    profiling = False
+    profileHook = None
+
+def sniff(filename, fileobj=None):
+    """Classify a flat file from its axis hierarchy only, without parsing the
+    rest of the file, usually a single read of SNIFF_BUFFER_SIZE bytes.
+
+    Return a dictionary with the 'kind' of data, 'topo', 'ivcurve', 'ivmap'
+    or 'izcurve' (None if unknown), the 'dimension', the 'axes' names, the
+    size of each scan direction 'xres', 'yres' and 'vres' or 'zres' as
+    relevant, and the 'mirrored' axes. The axes are identified by the last
+    part of their name, so all the Matrix versions are handled. As for
+    FlatFile, filename can be in an archive or read from fileobj."""
+
+    with _opened(filename, fileobj) as (flatFile, fileSize):
+        cursor = _Cursor(flatFile)
+        cursor.bufferSize = SNIFF_BUFFER_SIZE
+
+        axes = OrderedDict()
+        try:
+            if cursor.read(8) != 'FLAT0100':
+                raise CorruptFileError(filename, 'header', 0,
+                                       'Not a flat file of version 0100')
+
+            for i in range(cursor.readInt()):
+                name = cursor.readString()
+                cursor.skipString() # trigger axis
+                cursor.skipString() # unit
+                clockCount = cursor.readInt()
+                cursor.skip(4 + 4 + 8 + 8) # start, increment and physical values
+                mirrored = bool(cursor.readInt())
+
+                tableSets = {}
+                for j in range(cursor.readInt()):
+                    triggerAxisName = cursor.readString()
+                    tableSets[triggerAxisName.split('::')[-1]] = [
+                        (cursor.readInt(), cursor.readInt(), cursor.readInt())
+                        for k in range(cursor.readInt())]
+
+                axes[name.split('::')[-1]] = {'clockCount': clockCount,
+                                              'mirrored': mirrored,
+                                              'tableSets': tableSets}
+        except CorruptFileError, error:
+            error.locate(filename, 'header')
+            raise
+
+    def size(name):
+        return int(axes[name]['clockCount'] / (axes[name]['mirrored'] + 1))
+
+    info = {'kind': None,
+            'dimension': len(axes),
+            'axes': axes.keys(),
+            'mirrored': [name for name in axes if axes[name]['mirrored']]}
+
+    if len(axes) == 2 and 'X' in axes and 'Y' in axes:
+        info.update(kind='topo', xres=size('X'), yres=size('Y'))
+    elif len(axes) == 1 and 'V' in axes:
+        info.update(kind='ivcurve', vres=size('V'))
+    elif len(axes) == 1 and 'Z' in axes:
+        info.update(kind='izcurve', zres=size('Z'))
+    elif len(axes) == 3 and 'X' in axes and 'Y' in axes and 'V' in axes:
+        tableSets = axes['V']['tableSets']
+        info.update(kind='ivmap', vres=size('V'))
+        for name in ('X', 'Y'):
+            if tableSets.get(name):
+                start, stop, step = tableSets[name][0]
+                info[name.lower() + 'res'] = (stop - start) // step + 1
+            else:
+                info[name.lower() + 'res'] = size(name)
+
+    return info
+
+def validate(filename, fileobj=None):
+    """Check the structure of a flat file without decoding its values: every
+    count and string length is checked against the size of the file, the
+    raw data are skipped, and the file must end with the last section.
+
+    Raise a CorruptFileError giving the section and the byte offset of the
+    first problem found, or UnhandledTransferFunction. This is much faster
+    than a full parse, e.g. to reject bad files before a bulk ingest. As for
+    FlatFile, filename can be in an archive or read from fileobj."""
+
+    with _opened(filename, fileobj) as (flatFile, fileSize):
+        cursor = _Cursor(flatFile)
+        section = ['header']
+
+        def check(condition, message):
+            if not condition:
+                raise CorruptFileError(filename, section[0], cursor.tell(),
+                                       message)
+
+        def readCount(itemSize):
+            count = cursor.readInt()
+            check(0 <= count and cursor.tell() + count * itemSize <= fileSize,
+                  'Invalid count %i' % count)
+            return count
+
+        def skipString():
+            cursor.skip(2 * readCount(2))
+
+        try:
+            check(cursor.read(4) == 'FLAT', 'Not a flat file')
+            check(cursor.read(4) == '0100', 'Unhandled version')
+
+            section[0] = 'axes'
+            for i in range(readCount(1)):
+                skipString() # name
+                skipString() # trigger axis
+                skipString() # unit
+                cursor.skip(4 + 4 + 4 + 8 + 8 + 4)
+                for j in range(readCount(1)):
+                    skipString() # trigger axis
+                    cursor.skip(12 * readCount(12)) # intervals
+
+            section[0] = 'channel'
+            skipString() # name
+            transferFunctionName = cursor.readString()
+            if transferFunctionName not in ('TFF_Linear1D', 'TFF_MultiLinear1D'):
+                raise UnhandledTransferFunction, \
+                    'Unknown transfer function %s in %s' % (transferFunctionName, filename)
+            skipString() # unit
+            for i in range(readCount(1)):
+                skipString()
+                cursor.skip(8)
+            cursor.skip(4 * readCount(4)) # data views
+
+            section[0] = 'creationInformation'
+            cursor.skip(8) # timestamp
+            skipString() # comment
+
+            section[0] = 'data'
+            cursor.readInt() # bricklet size
+            cursor.skip(4 * readCount(4))
+
+            section[0] = 'trailer'
+            cursor.skip(16 * readCount(16)) # offsets
+            for i in range(9):
+                skipString()
+            cursor.skip(8) # run and scan cycles
+
+            # The parameter lists are the longest sections, the strings are
+            # checked by the cursor and the end of file by _require().
+            skipParameter = cursor.skipString
+            readInt = cursor.readInt
+
+            section[0] = 'experimentElement'
+            for i in range(readCount(1)):
+                skipString() # instance name
+                for j in range(readCount(1)):
+                    skipParameter() # name
+                    typeCode = readInt()
+                    if not 1 <= typeCode <= 5:
+                        check(False, 'Unknown parameter type %i' % typeCode)
+                    skipParameter() # unit
+                    skipParameter() # value
+
+            section[0] = 'experimentDeployement'
+            for i in range(readCount(1)):
+                skipString() # instance name
+                for j in range(readCount(1)):
+                    skipParameter()
+                    skipParameter()
+
+            check(cursor.tell() == fileSize, '%i unknown bytes at the end of the file' %
+                  (fileSize - cursor.tell()))
+        except CorruptFileError, error:
+            error.locate(filename, section[0])
+            raise
+
+def read_header(filename, fileobj=None):
+    """Parse all the sections of a flat file except the raw data which are
+    skipped. Return the FlatFile object, its DataArray hold the info of each
+    scan direction but no data."""
 
-    ff = FlatFile(filename)
-    return ff.getData()
+    return FlatFile(filename, header_only=True, fileobj=fileobj)
 
 if __name__ == "__main__":
     pass
\ No newline at end of file
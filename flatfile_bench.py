@@ -0,0 +1,319 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+    Benchmark of the flat file parser.
+
+    Synthetic Omicron FLAT 0100 files are generated in a temporary folder:
+    topographies with every mirroring combination, I(V) curves and CITS
+    cubes of configurable size, Matrix version and number of experiment
+    parameters. Each file is parsed in a separate process, which reports the
+    best parsing time over a few runs and its peak memory. The throughput is
+    given in MB/s of file and samples/s.
+
+    The results can be saved as JSON and compared to a previous run, e.g.
+
+        python flatfile_bench.py -o before.json
+        (apply some changes)
+        python flatfile_bench.py -o after.json --compare before.json
+"""
+
+import os
+import sys
+import json
+import time
+import struct
+import shutil
+import platform
+import tempfile
+import argparse
+import datetime
+import subprocess
+import numpy as np
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+# Number of samples written at once in the synthetic files
+WRITE_BLOCK_SIZE = 2**20
+
+AXIS_NAMES = {
+    'MATRIX V3.0': {'V': 'V', 'X': 'X', 'Y': 'Y'},
+    'MATRIX V3.1-1': {'V': 'Default::Spectroscopy::V',
+                      'X': 'Default::XYScanner::X',
+                      'Y': 'Default::XYScanner::Y'},
+    }
+
+parser = argparse.ArgumentParser(description='''Benchmark of the flat file
+parser on synthetic files.''')
+
+parser.add_argument('--topo', nargs=2, type=int, default=[512, 512],
+    metavar=('NX', 'NY'), help='Size of the topographies')
+parser.add_argument('--iv', type=int, default=2000, metavar='NV',
+    help='Number of points of the I(V) curves')
+parser.add_argument('--cits', nargs=3, type=int, default=[64, 64, 200],
+    metavar=('NX', 'NY', 'NV'), help='Size of the CITS cubes')
+parser.add_argument('--version', default='MATRIX V3.1-1',
+    choices=sorted(AXIS_NAMES.keys()), help='Matrix version of the files')
+parser.add_argument('--parameters', type=int, default=100,
+    help='Number of experiment elements in the files')
+parser.add_argument('--mode', action='append',
+    choices=['eager', 'physical', 'mmap', 'header'],
+    help='''Parsing mode, eager loads the data counts, physical also converts
+them to physical values, mmap maps them and header skips them. Can be given
+several times, default eager.''')
+parser.add_argument('--repeat', type=int, default=3,
+    help='Number of parsing of each file, the best time is reported')
+parser.add_argument('-o', '--output', help='Save the results in a JSON file')
+parser.add_argument('--compare', help='JSON file of a previous run to compare with')
+parser.add_argument('--keep', metavar='FOLDER',
+    help='Write the synthetic files in FOLDER and keep them')
+parser.add_argument('--child', nargs=3, metavar=('FILE', 'MODE', 'REPEAT'),
+    help='Internal, measure a single file in this process')
+
+#
+# Synthetic flat files
+#
+
+def pack_int(value):
+    return struct.pack('<i', value)
+
+def pack_double(value):
+    return struct.pack('<d', value)
+
+def pack_string(text):
+    if not text:
+        return pack_int(0)
+    return pack_int(len(text)) + text.encode('utf-16-le')
+
+def pack_axis(name, trigger, unit, clock_count, mirrored, table_sets=(),
+              start=0.0, increment=1e-10):
+    block = pack_string(name) + pack_string(trigger) + pack_string(unit) + \
+            pack_int(clock_count) + pack_int(0) + pack_int(1) + \
+            pack_double(start) + pack_double(increment) + \
+            pack_int(int(mirrored)) + pack_int(len(table_sets))
+    for trigger_name, intervals in table_sets:
+        block += pack_string(trigger_name) + pack_int(len(intervals))
+        for interval in intervals:
+            block += ''.join(pack_int(i) for i in interval)
+    return block
+
+def write_flat(path, kind, nx=8, ny=8, nv=8, mirrored_x=False,
+               mirrored_y=False, mirrored_v=False, version='MATRIX V3.1-1',
+               parameters=10, seed=0):
+    """Write a synthetic flat file of kind 'topo', 'iv' or 'grid' with
+       random data, return the number of samples."""
+
+    names = AXIS_NAMES[version]
+    mx, my, mv = int(mirrored_x), int(mirrored_y), int(mirrored_v)
+
+    if kind == 'topo':
+        axes = [pack_axis(names['X'], names['X'], u'm', nx*(mx+1), mx),
+                pack_axis(names['Y'], names['X'], u'm', ny*(my+1), my)]
+        samples = nx*(mx+1) * ny*(my+1)
+    elif kind == 'iv':
+        axes = [pack_axis(names['V'], names['V'], u'V', nv*(mv+1), mv,
+                          start=-1.0, increment=0.01)]
+        samples = nv*(mv+1)
+    elif kind == 'grid':
+        table_x = [(0, nx-1, 1)] + ([(nx, 2*nx-1, 1)] if mx else [])
+        table_y = [(0, ny-1, 1)] + ([(ny, 2*ny-1, 1)] if my else [])
+        axes = [pack_axis(names['V'], names['V'], u'V', nv*(mv+1), mv,
+                          [(names['X'], table_x), (names['Y'], table_y)],
+                          start=-1.0, increment=0.01),
+                pack_axis(names['X'], names['X'], u'm', nx*(mx+1), mx),
+                pack_axis(names['Y'], names['X'], u'm', ny*(my+1), my)]
+        samples = nx*(mx+1) * ny*(my+1) * nv*(mv+1)
+    else:
+        raise ValueError('Unknown kind %s' % kind)
+
+    header = 'FLAT0100' + pack_int(len(axes)) + ''.join(axes)
+    header += pack_string(u'I') + pack_string(u'TFF_Linear1D') + \
+              pack_string(u'A') + pack_int(2) + \
+              pack_string(u'Offset') + pack_double(3.5) + \
+              pack_string(u'Factor') + pack_double(-7.3e9)
+    header += pack_int(1) + pack_int(3) # data views
+    header += struct.pack('<q', 1461234567) + pack_string(u'Benchmark')
+    header += pack_int(samples) + pack_int(samples)
+
+    trailer = pack_int(1) + pack_double(1e-9) + pack_double(2e-9)
+    for i in range(9):
+        trailer += pack_string(version if i == 5 else u'info %i' % i)
+    trailer += pack_int(1) + pack_int(1)
+
+    elements = [(u'Regulator', [(u'Setpoint_1', 2, u'A', u'1e-10')]),
+                (u'GapVoltageControl', [(u'Voltage', 2, u'V', u'1.5')])]
+    for i in range(parameters):
+        elements.append((u'Element%i' % i, [
+            (u'Integer', 1, u'--', u'42'),
+            (u'Double', 2, u'm', u'2.5e-3'),
+            (u'Boolean', 3, u'--', u'true'),
+            (u'Enum', 4, u'--', u'3'),
+            (u'String', 5, u'--', u'h\xe9llo')]))
+    trailer += pack_int(len(elements))
+    for name, values in elements:
+        trailer += pack_string(name) + pack_int(len(values))
+        for parameter, type_code, unit, value in values:
+            trailer += pack_string(parameter) + pack_int(type_code) + \
+                       pack_string(unit) + pack_string(value)
+    trailer += pack_int(1) + pack_string(u'Deployment') + pack_int(1) + \
+               pack_string(u'key') + pack_string(u'value')
+
+    random = np.random.RandomState(seed)
+    with open(path, 'wb') as flat_file:
+        flat_file.write(header)
+        for start in range(0, samples, WRITE_BLOCK_SIZE):
+            count = min(WRITE_BLOCK_SIZE, samples - start)
+            data = random.randint(-2**31, 2**31 - 1, size=count)
+            flat_file.write(data.astype('<i4').tostring())
+        flat_file.write(trailer)
+
+    return samples
+
+def build_cases(args):
+    """Return the list of (name, kind, write_flat arguments) to measure"""
+
+    nx, ny = args.topo
+    cases = []
+    for mx in (False, True):
+        for my in (False, True):
+            cases.append(('topo-%ix%i-mx%i-my%i' % (nx, ny, mx, my), 'topo',
+                          dict(nx=nx, ny=ny, mirrored_x=mx, mirrored_y=my)))
+    for mv in (False, True):
+        cases.append(('iv-%i-mv%i' % (args.iv, mv), 'iv',
+                      dict(nv=args.iv, mirrored_v=mv)))
+    nx, ny, nv = args.cits
+    for mirrored in (False, True):
+        cases.append(('cits-%ix%ix%i-m%i' % (nx, ny, nv, mirrored), 'grid',
+                      dict(nx=nx, ny=ny, nv=nv, mirrored_x=mirrored,
+                           mirrored_y=mirrored, mirrored_v=mirrored)))
+    return cases
+
+#
+# Measurements
+#
+
+def peak_memory():
+    """Return the peak resident memory of this process in MB, or None"""
+
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': # bytes instead of kB
+        maxrss /= 1024.
+    return maxrss / 1024.
+
+def measure(path, mode, repeat):
+    """Parse path repeat times in this process and return the timings"""
+
+    import flatfile
+
+    base_memory = peak_memory()
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        ff = flatfile.FlatFile(path, mmap=(mode == 'mmap'),
+                               header_only=(mode == 'header'))
+        if mode == 'physical':
+            for dataArray in ff.getData():
+                dataArray.data
+        times.append(time.time() - start)
+        del ff
+
+    return {'times': times,
+            'base_memory_mb': base_memory,
+            'peak_memory_mb': peak_memory()}
+
+def run_child(path, mode, repeat):
+    """Measure path in a new process, so the peak memory is its own"""
+
+    script = os.path.abspath(__file__)
+    if script.endswith('.pyc'):
+        script = script[:-1]
+    output = subprocess.check_output([sys.executable, script, '--child',
+                                      path, mode, str(repeat)])
+    return json.loads(output.splitlines()[-1])
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, previous):
+    """Print the ratio of the parsing times with a previous run"""
+
+    before = dict(((r['name'], r['mode']), r) for r in previous['results'])
+    print
+    print 'Compared to %s (%s)' % (previous.get('commit'), previous.get('date'))
+    for result in results:
+        old = before.get((result['name'], result['mode']))
+        if old is None:
+            continue
+        print '%-28s %-8s %8.3f s -> %8.3f s  x%.2f' % (
+                result['name'], result['mode'], old['time'], result['time'],
+                old['time'] / result['time'])
+
+def main():
+    args = parser.parse_args()
+
+    if args.child:
+        path, mode, repeat = args.child
+        print json.dumps(measure(path, mode, int(repeat)))
+        return
+
+    modes = args.mode or ['eager']
+    folder = args.keep or tempfile.mkdtemp(prefix='flatfile_bench')
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    results = []
+    try:
+        for name, kind, options in build_cases(args):
+            path = os.path.join(folder, name + '.flat')
+            samples = write_flat(path, kind, version=args.version,
+                                 parameters=args.parameters, **options)
+            size = os.path.getsize(path)
+
+            for mode in modes:
+                measured = run_child(path, mode, args.repeat)
+                best = min(measured['times'])
+                result = {'name': name, 'kind': kind, 'mode': mode,
+                          'file_size': size, 'samples': samples, 'time': best,
+                          'mb_per_s': size / 2.**20 / best,
+                          'samples_per_s': samples / best}
+                result.update(measured)
+                results.append(result)
+                print '%-28s %-8s %8.3f s %9.1f MB/s %12.3g samples/s %s' % (
+                        name, mode, best, result['mb_per_s'],
+                        result['samples_per_s'],
+                        '%8.1f MB peak' % result['peak_memory_mb']
+                        if result['peak_memory_mb'] is not None else '')
+    finally:
+        if not args.keep:
+            shutil.rmtree(folder)
+
+    report = {'date': datetime.datetime.now().isoformat(' '),
+              'commit': git_commit(),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'platform': platform.platform(),
+              'arguments': dict((key, value) for key, value in vars(args).items()
+                                if key not in ('output', 'compare', 'keep', 'child')),
+              'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(results, json.load(previous))
+
+if __name__ == "__main__":
+    main()
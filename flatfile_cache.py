@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Persistent on-disk cache of parsed flat files.
+
+    Each entry is made of a numpy .npy file holding the raw data counts and a
+    pickled sidecar holding the parsed sections of the file. Entries are keyed
+    by the absolute path of the flat file and are only used if the size and
+    the modification time of the file did not change, otherwise they are
+    removed. The total size of the cache is bounded, the least recently used
+    entries are evicted first.
+
+    The cache is enabled with flatfile.enable_disk_cache(directory).
+"""
+
+import os
+import hashlib
+import tempfile
+import cPickle as pickle
+import numpy as np
+
+DEBUG = False
+
+# Increase when the content of the entries changes, older entries are then
+# treated as stale.
+CACHE_VERSION = 2
+
+# Default maximum size of the cache in bytes
+DEFAULT_MAX_SIZE = 4 * 2**30
+
+# Once full, the cache is evicted down to this fraction of its maximum size,
+# so the next entries do not each trigger a scan of the directory
+EVICT_RATIO = 0.9
+
+META_EXTENSION = '.meta'
+DATA_EXTENSION = '.npy'
+
+def file_key(filename):
+    """Return the absolute path, size and modification time of filename"""
+
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    return path, stat.st_size, stat.st_mtime
+
+class DiskCache():
+    """ Cache of parsed flat files in a directory. """
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        """ \arg directory where the entries are stored, created if needed.
+            \arg max_size maximum size of the cache in bytes.
+        """
+
+        self.directory = directory
+        self.max_size = max_size
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # Running total of the size of the entries, so put() does not scan
+        # the directory. Other processes sharing the directory make it drift,
+        # it is computed again whenever the entries are evicted.
+        self.total = self.size()
+
+    def _entry(self, path):
+        """Return the sidecar and the data file names of the entry of path"""
+
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        name = os.path.join(self.directory, hashlib.sha1(path).hexdigest())
+        return name + META_EXTENSION, name + DATA_EXTENSION
+
+    def get(self, filename, load_data=True):
+        """Return the (state, data) stored for filename, or None if there is
+           no valid entry. If load_data is False, data is None."""
+
+        path, size, mtime = file_key(filename)
+        metaName, dataName = self._entry(path)
+
+        try:
+            with open(metaName, 'rb') as metaFile:
+                meta = pickle.load(metaFile)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+
+        if (meta['version'], meta['path'], meta['size'], meta['mtime']) != \
+           (CACHE_VERSION, path, size, mtime):
+            if DEBUG: print 'Stale cache entry for %s' % path
+            self.total -= self._entrySize(metaName, dataName)
+            self._remove(metaName, dataName)
+            return None
+
+        data = None
+        if load_data:
+            try:
+                data = np.load(dataName)
+            except IOError:
+                return None
+
+        # Mark the entry as recently used
+        try:
+            os.utime(metaName, None)
+        except OSError:
+            pass
+
+        return meta['state'], data
+
+    def put(self, filename, state, data):
+        """Store the state dictionary and the data array of filename"""
+
+        path, size, mtime = file_key(filename)
+        metaName, dataName = self._entry(path)
+
+        meta = {'version': CACHE_VERSION,
+                'path': path,
+                'size': size,
+                'mtime': mtime,
+                'state': state}
+
+        previousSize = self._entrySize(metaName, dataName)
+
+        # Data first, the sidecar is only valid once the data are written
+        self._write(dataName, lambda f: np.save(f, data))
+        self._write(metaName,
+                    lambda f: pickle.dump(meta, f, pickle.HIGHEST_PROTOCOL))
+
+        self.total += self._entrySize(metaName, dataName) - previousSize
+        if self.total > self.max_size:
+            self.evict()
+
+    def _write(self, name, write):
+        """Write a file through a temporary file, so other readers never see
+           a partial entry."""
+
+        fd, tempName = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tempFile:
+                write(tempFile)
+            try:
+                os.rename(tempName, name)
+            except OSError: # Windows cannot rename over an existing file
+                os.remove(name)
+                os.rename(tempName, name)
+        except:
+            if os.path.exists(tempName):
+                os.remove(tempName)
+            raise
+
+    def _entrySize(self, *names):
+        """Return the total size of the existing files among names"""
+
+        size = 0
+        for name in names:
+            try:
+                size += os.path.getsize(name)
+            except OSError:
+                pass
+        return size
+
+    def _remove(self, *names):
+        for name in names:
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+    def entries(self):
+        """Return a list of (last use time, size, sidecar name, data name) of
+           the entries, the least recently used first."""
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(META_EXTENSION):
+                continue
+            metaName = os.path.join(self.directory, name)
+            dataName = metaName[:-len(META_EXTENSION)] + DATA_EXTENSION
+            try:
+                stat = os.stat(metaName)
+                size = stat.st_size + os.path.getsize(dataName)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, size, metaName, dataName))
+        entries.sort()
+        return entries
+
+    def size(self):
+        """Return the total size of the cache in bytes"""
+
+        return sum(entry[1] for entry in self.entries())
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in
+           EVICT_RATIO * max_size. The directory is scanned, put() only calls
+           it once the running total exceeds max_size."""
+
+        entries = self.entries()
+        total = sum(entry[1] for entry in entries)
+        if total <= self.max_size:
+            self.total = total
+            return
+        for lastUse, size, metaName, dataName in entries:
+            if total <= EVICT_RATIO * self.max_size:
+                break
+            if DEBUG: print 'Evict cache entry %s' % metaName
+            self._remove(metaName, dataName)
+            total -= size
+        self.total = total
+
+    def clear(self):
+        """Remove all the entries"""
+
+        for lastUse, size, metaName, dataName in self.entries():
+            self._remove(metaName, dataName)
+        self.total = 0
@@ -18,6 +18,10 @@ import matplotlib.patches as patches
 
 import flatfile
 
+# Minimum number of files for import_multiple_data() to start a process pool,
+# below it starting the workers costs more than parsing the files in turn.
+POOL_MIN_FILES = 64
+
 """
     %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
     %%%            Data Importing             %%%
@@ -33,6 +37,14 @@ def import_data(file_name):
     file_data = flatfile.load(file_name)
     return file_data
 
+def import_multiple_data(file_names, workers=1):
+    # Files are loaded in turn with import_data(), so the memory cache of
+    # flatfile.load() is used. With workers > 1 and at least POOL_MIN_FILES
+    # files, they are parsed in a pool of processes, see flatfile.load_many()
+    if workers is not None and workers <= 1 or len(file_names) < POOL_MIN_FILES:
+        return [import_data(file_name) for file_name in file_names]
+    return flatfile.load_many(file_names, workers=workers)
+
 def extract_data_type(file_data):
     data_type = file_data[0].info['type']
     return data_type
@@ -60,6 +72,75 @@ def extract_cits_data(file_data):
         cits_data.append(file_data[i].data)
     return cits_data
 
+def import_cits_header(file_name):
+    # Only the header is parsed, use with extract_cits_slice() and
+    # extract_cits_spectrum() to read the values on demand
+    return flatfile.read_header(file_name)
+
+def extract_cits_slice(cits_file, energy_slice, scan_dir=0):
+    direction = cits_file.getData()[scan_dir].info['direction']
+    return cits_file.readSlice(direction, energy_slice)
+
+def extract_cits_spectrum(cits_file, x_loc, y_loc, scan_dir=0):
+    direction = cits_file.getData()[scan_dir].info['direction']
+    return cits_file.readSpectrum(direction, x_loc, y_loc)
+
+"""
+    The functions below process a CITS cube block by block, see
+    FlatFile.iterSlices(), iterTiles() and iterSpectra(), so only one block
+    is held in memory at once. Pass a numpy.memmap (e.g. from
+    np.lib.format.open_memmap) as out to also keep the result on the disk.
+"""
+
+def iter_cits_chunks(cits_file, scan_dir=0, by='spectra', size=None):
+    # by is 'slices', 'tiles' or 'spectra', yield (key, block) with
+    # cube[key] == block
+    direction = cits_file.getData()[scan_dir].info['direction']
+    iterators = {'slices': cits_file.iterSlices,
+                 'tiles': cits_file.iterTiles,
+                 'spectra': cits_file.iterSpectra}
+    return iterators[by](direction, size)
+
+def cits_shape(cits_file):
+    info = cits_file.getData()[0].info
+    return info['vres'], info['yres'], info['xres']
+
+def normalise_cits(cits_file, scan_dir=0, out=None, size=None):
+    # Divide each spectrum by its maximum absolute value
+    if out is None:
+        out = np.empty(cits_shape(cits_file))
+    for key, block in iter_cits_chunks(cits_file, scan_dir, 'spectra', size):
+        norm = np.amax(np.abs(block), axis=0)
+        norm[norm == 0] = 1
+        out[key] = block / norm
+    return out
+
+def derivative_cits(cits_file, scan_dir=0, out=None, size=None):
+    # Numerical derivative of each spectrum with respect to the voltage
+    v_inc = cits_file.getData()[scan_dir].info['vinc']
+    if out is None:
+        out = np.empty(cits_shape(cits_file))
+    for key, block in iter_cits_chunks(cits_file, scan_dir, 'spectra', size):
+        out[key] = np.gradient(block, v_inc, axis=0)
+    return out
+
+def average_cits_spectrum(cits_file, scan_dir=0, size=None):
+    # Average of the spectra of all the pixels
+    v_res, y_res, x_res = cits_shape(cits_file)
+    total = np.zeros(v_res)
+    for key, block in iter_cits_chunks(cits_file, scan_dir, 'spectra', size):
+        total += block.sum(axis=(1, 2))
+    return total / (y_res * x_res)
+
+def cits_slice_range(cits_file, scan_dir=0, size=None):
+    # Minimum and maximum of each voltage slice, e.g. for the colour scale
+    slice_min = []
+    slice_max = []
+    for key, block in iter_cits_chunks(cits_file, scan_dir, 'slices', size):
+        slice_min.extend(np.amin(block, axis=(1, 2)))
+        slice_max.extend(np.amax(block, axis=(1, 2)))
+    return np.array(slice_min), np.array(slice_max)
+
 def extract_cits_info(file_data):
     cits_info = {}
     for i in range(0, len(file_data)):
@@ -704,9 +785,7 @@ def plt_spec(data_location, filename, number=1, showplt='y', returnall='n'):
     for i in range(0, no):
         file_locations.append(loc+filename+str(i+1)+'.Aux1(V)_FLAT')
 
-    file_filedata = []
-    for i in range(0, no):
-        file_filedata.append(import_data(file_locations[i]))
+    file_filedata = import_multiple_data(file_locations)
 
     file_info = extract_spec_info(file_filedata[0])
 
@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Reader of the Omicron Matrix result files (.mtrx), without converting them
+    to flat files with VernissageCmd first.
+
+    A Matrix session writes one data file per channel and scan, e.g.
+    default_2016Apr21-101010_STM-STM_Spectroscopy--12_3.Z_mtrx, and a single
+    parameter file default_2016Apr21-101010_STM-STM_Spectroscopy_0001.mtrx
+    holding the chain of the session events: the initial experiment element
+    parameters, every parameter change and a reference to each data file
+    when it is written. The state of the parameters at the reference of a
+    data file gives its scan geometry and its transfer function.
+
+    Both files start with 'ONTMATRX0101' followed by tagged blocks: a four
+    letters tag stored reversed, the int32 size of the content and the
+    content, starting with an int64 timestamp except for the DATA block of
+    the raw values. The values are stored as in the flat files: little
+    endian int32 and double, and strings as an int32 number of UTF-16
+    characters.
+
+    MtrxFile builds the same DataArray and info as flatfile.FlatFile, for
+    topographies and point I(V) spectroscopies. The layout of the blocks
+    follows the published descriptions of the format (e.g. the Gwyddion
+    Matrix module), it is checked against the synthetic session of
+    tests/data/mtrx. The grid and Z spectroscopies are not handled.
+"""
+
+import os
+import re
+import datetime
+from numpy import memmap
+import flatfile
+from flatfile import FlatFile, TransferFunction, CorruptFileError, \
+    UnhandledFileError, UnhandledDataType, UnhandledTransferFunction, \
+    ParameterTypeError
+
+DEBUG = False
+
+FILE_IDENTIFIER = 'ONTMATRX0101'
+
+# Blocks made of other blocks, after their timestamp
+CONTAINER_TAGS = ('BKLT', 'CCSY')
+
+# Data file name: session prefix, run and scan cycles, channel name
+DATA_FILE_PATTERN = re.compile(r'^(?P<prefix>.*)--(?P<run>\d+)_(?P<cycle>\d+)'
+                               r'\.(?P<channel>.+)_mtrx$')
+
+def _readValue(cursor):
+    """Read a parameter value preceded by its type code, the codes are the
+       same as in the flat files."""
+
+    typeCode = cursor.readInt()
+    if typeCode == 1 : # 32 bits integer
+        return cursor.readInt()
+    elif typeCode == 2 : # Double precision float
+        return cursor.readDouble()
+    elif typeCode == 3 : # Boolean
+        return bool(cursor.readInt())
+    elif typeCode == 4 : # Enum
+        return cursor.readInt()
+    elif typeCode == 5 : # Unicode character string
+        return cursor.readString()
+    raise ParameterTypeError, 'Unknown parameter type %i given' % typeCode
+
+def _iterBlocks(cursor, end):
+    """Yield (tag, end of the content) of the blocks from the cursor up to
+       end. The cursor is at the start of the content of the yielded block,
+       it is moved to its end before the next one."""
+
+    while cursor.tell() < end :
+        start = cursor.tell()
+        tag = cursor.read(4)[::-1]
+        size = cursor.readInt()
+        contentEnd = cursor.tell() + size
+        if size < 0 or contentEnd > end :
+            raise CorruptFileError(None, tag, start,
+                                   'Invalid size %i of a block' % size)
+        yield tag, contentEnd
+        if cursor.tell() > contentEnd :
+            raise CorruptFileError(None, tag, contentEnd,
+                                   'Block decoded past its end')
+        cursor.skip(contentEnd - cursor.tell())
+
+def parameter_file_name(filename):
+    """Return the path of the parameter file of the data file filename."""
+
+    match = DATA_FILE_PATTERN.match(os.path.basename(filename))
+    if match is None:
+        raise UnhandledFileError, '%s is not a Matrix data file name' % filename
+    return os.path.join(os.path.dirname(filename),
+                        match.group('prefix') + '_0001.mtrx')
+
+class MtrxFile(FlatFile):
+    """Parse a Matrix data file and the parameter chain of its session into
+       the same structures as a FlatFile. """
+
+    def __init__(self, filename, mmap=False, header_only=False,
+                 parameter_file=None):
+        """ \arg filename path to a Matrix data file, e.g. *.Z_mtrx.
+            \arg parameter_file path to the _0001.mtrx parameter file of the
+            session, by default found from filename.
+            See FlatFile for the other arguments.
+        """
+
+        self.parameterFile = parameter_file or parameter_file_name(filename)
+        FlatFile.__init__(self, filename, mmap, header_only)
+
+    def openFlatFile(self):
+        """ Parse the data file up to the raw data, the parameter file up to
+            the reference to the data file, then read the raw data.
+        """
+
+        match = DATA_FILE_PATTERN.match(os.path.basename(self.filename))
+        if match is None:
+            raise UnhandledFileError, '%s is not a Matrix data file name' % self.filename
+
+        self.file, fileSize = flatfile._openFile(self.filename)
+        self.cursor = flatfile._Cursor(self.file)
+
+        with self._section('header'):
+            self._readBricklet(fileSize)
+        with self._section('parameters'):
+            self._readParameters(match)
+        with self._section('data'):
+            self._readData()
+
+        self.file.close()
+        self.file = None
+        self.cursor = None
+
+        if self.mmap and not self.headerOnly :
+            self.rawData = memmap(os.path.normpath(self.filename), dtype='<i4',
+                                  mode='r', offset=self.dataOffset,
+                                  shape=(self.dataItemSize,))
+
+        with self._section('reshape'):
+            self._reshapeData()
+
+    def _readBricklet(self, fileSize):
+        """ Find the raw data in the blocks of the data file """
+
+        if FILE_IDENTIFIER != self.cursor.read(len(FILE_IDENTIFIER)) :
+            raise CorruptFileError(self.filename, 'header', 0,
+                                   'Not a Matrix file')
+
+        self.timestamp = None
+        blocks = [_iterBlocks(self.cursor, fileSize)]
+        while blocks :
+            for tag, end in blocks[-1] :
+                if tag in CONTAINER_TAGS :
+                    self.timestamp = self.cursor.readLong()
+                    blocks.append(_iterBlocks(self.cursor, end))
+                    break
+                elif tag == 'DATA' :
+                    self.dataOffset = self.cursor.tell()
+                    self.dataCount = (end - self.dataOffset) // 4
+                    return
+            else :
+                blocks.pop()
+
+        raise CorruptFileError(self.filename, 'header', self.cursor.tell(),
+                               'No data block')
+
+    def _readParameters(self, match):
+        """ Decode the parameter chain and build the axes, the channel and
+            the other sections of a flat file from it. """
+
+        parameterFile, size = flatfile._openFile(self.parameterFile)
+        try:
+            cursor = flatfile._Cursor(None, parameterFile.read())
+        finally:
+            parameterFile.close()
+
+        if FILE_IDENTIFIER != cursor.read(len(FILE_IDENTIFIER)) :
+            raise CorruptFileError(self.parameterFile, 'header', 0,
+                                   'Not a Matrix file')
+
+        self.experimentElement = {}
+        self.transferFunctions = {} # by channel id
+        self.channels = {} # channel id by name
+
+        dataName = os.path.basename(self.filename)
+        try:
+            found = self._walkParameters(cursor, len(cursor.buffer), dataName)
+        except CorruptFileError, error:
+            error.locate(self.parameterFile, None)
+            raise
+        if not found :
+            raise UnhandledFileError, '%s is not referenced in %s' % (
+                dataName, self.parameterFile)
+
+        self._buildAxes(match.group('channel'))
+        self._buildChannel(match.group('channel'))
+
+        self.creationInformation = {
+            'timestamp': self.timestamp,
+            'date': datetime.datetime.fromtimestamp(
+                float(self.timestamp or 0)).isoformat(' '),
+            'comment': None,
+            }
+        self.experimentInfo = dict((name, None) for name in (
+            'Name', 'Version', 'Description', 'File Specification',
+            'File Creator', 'Result File Creator', 'User Name',
+            'Account Name', 'Result Data File Specification'))
+        self.experimentInfo['Run Cycle'] = int(match.group('run'))
+        self.experimentInfo['Scan Cycle'] = int(match.group('cycle'))
+        self.experimentDeployement = {}
+        self.offset = []
+
+        self.dataItemSize = self.dataCount
+        if self.dataItemSize > self.brickletSize :
+            raise UnhandledDataType, \
+                'The data file %s holds more values than its axes' % self.filename
+
+    def _walkParameters(self, cursor, end, dataName):
+        """ Apply the blocks of the parameter chain up to the reference to
+            dataName, return True if it was found. """
+
+        for tag, blockEnd in _iterBlocks(cursor, end) :
+
+            if tag in CONTAINER_TAGS :
+                cursor.readLong() # timestamp
+                if self._walkParameters(cursor, blockEnd, dataName) :
+                    return True
+
+            elif tag == 'EEPA' : # Initial experiment element parameters
+                cursor.readLong() # timestamp
+                cursor.skip(4)
+                for i in range(cursor.readInt()) :
+                    instance = self.experimentElement.setdefault(
+                        cursor.readString(), {})
+                    for j in range(cursor.readInt()) :
+                        name = cursor.readString()
+                        unit = cursor.readString()
+                        cursor.skip(4)
+                        instance[name] = {'value': _readValue(cursor),
+                                          'unit': unit}
+
+            elif tag == 'PMOD' : # Parameter modified
+                cursor.readLong() # timestamp
+                cursor.skip(4)
+                instance = self.experimentElement.setdefault(
+                    cursor.readString(), {})
+                name = cursor.readString()
+                unit = cursor.readString()
+                cursor.skip(4)
+                instance[name] = {'value': _readValue(cursor), 'unit': unit}
+
+            elif tag == 'XFER' : # Transfer functions of the channels
+                cursor.readLong() # timestamp
+                while cursor.tell() < blockEnd :
+                    channelId = cursor.readInt()
+                    name = cursor.readString()
+                    unit = cursor.readString()
+                    parameters = {}
+                    for i in range(cursor.readInt()) :
+                        parameterName = cursor.readString()
+                        parameters[parameterName] = _readValue(cursor)
+                    self.transferFunctions[channelId] = (name, unit, parameters)
+
+            elif tag == 'DICT' : # Names of the axes and channels
+                cursor.readLong() # timestamp
+                for i in range(cursor.readInt()) :
+                    cursor.skip(16)
+                    cursor.skipString() # axis name
+                    cursor.skipString() # unit
+                for i in range(cursor.readInt()) :
+                    cursor.skip(4)
+                    channelId = cursor.readInt()
+                    cursor.skip(8)
+                    self.channels[cursor.readString()] = channelId
+                    cursor.skipString() # unit
+
+            elif tag == 'BREF' : # Reference to a data file written
+                cursor.readLong() # timestamp
+                cursor.skip(4)
+                if cursor.readString() == dataName :
+                    return True
+
+            elif DEBUG :
+                print 'Skip block %s of %i bytes' % (tag, blockEnd - cursor.tell())
+
+        return False
+
+    def _buildChannel(self, channelName):
+        """ Select the transfer function of the channel """
+
+        channelId = self.channels.get(channelName)
+        if channelId in self.transferFunctions :
+            name, unit, parameters = self.transferFunctions[channelId]
+        elif len(self.transferFunctions) == 1 :
+            name, unit, parameters = self.transferFunctions.values()[0]
+        else :
+            raise UnhandledTransferFunction, \
+                'No transfer function for the channel %s in %s' % (
+                    channelName, self.parameterFile)
+
+        if name not in ('TFF_Linear1D', 'TFF_MultiLinear1D') :
+            raise UnhandledTransferFunction, \
+                'Unknown transfer function %s in %s' % (name, self.parameterFile)
+
+        self.channel = {'name': channelName, 'unit': unit}
+        self.transferFunction = TransferFunction(name, parameters)
+
+    def _buildAxes(self, channelName):
+        """ Describe the scan axes as in a flat file, from the scanner and
+            spectroscopy parameters. """
+
+        self.axis_keys = self.axis_keys['MATRIX V3.1-1']
+
+        def value(instance, name):
+            try:
+                return self.experimentElement[instance][name]['value']
+            except KeyError:
+                raise UnhandledFileError, 'Missing parameter %s::%s for %s' % (
+                    instance, name, self.filename)
+
+        def axis(trigger, unit, count, mirrored, start, increment):
+            return {'trigger': trigger, 'unit': unit,
+                    'clockCount': count * (mirrored + 1),
+                    'startValue': 0, 'increment': 1,
+                    'startValuePhysical': start,
+                    'incrementPhysical': increment,
+                    'mirrored': mirrored, 'tableSets': {}}
+
+        self.axis = {}
+        if channelName.endswith('(V)') : # Point spectroscopy
+            points = value('Spectroscopy', 'Device_1_Points')
+            start = value('Spectroscopy', 'Device_1_Start')
+            end = value('Spectroscopy', 'Device_1_End')
+            mirrored = bool(value('Spectroscopy', 'Enable_Device_1_Ramp_Reversal'))
+            self.axis[self.axis_keys['V']] = axis(self.axis_keys['V'], u'V',
+                points, mirrored, start, (end - start) / max(points - 1, 1))
+            self.dataView = [5] # vtc_Spectroscopy
+        elif '(' not in channelName : # Image
+            pointsX = value('XYScanner', 'Points')
+            pointsY = value('XYScanner', 'Lines')
+            mirroredX = bool(value('XYScanner', 'X_Retrace'))
+            mirroredY = bool(value('XYScanner', 'Y_Retrace'))
+            self.axis[self.axis_keys['X']] = axis(self.axis_keys['X'], u'm',
+                pointsX, mirroredX, 0.0, value('XYScanner', 'Width') / pointsX)
+            self.axis[self.axis_keys['Y']] = axis(self.axis_keys['X'], u'm',
+                pointsY, mirroredY, 0.0, value('XYScanner', 'Height') / pointsY)
+            self.dataView = [3] # vtc_ForwardBackward2D
+        else :
+            raise UnhandledDataType, \
+                'The channel %s of %s is not handled' % (channelName, self.filename)
+
+        self.dimension = len(self.axis)
+        self.brickletSize = 1
+        for axisInfo in self.axis.values() :
+            self.brickletSize *= axisInfo['clockCount']
+
+def load(filename, mmap=False, parameter_file=None):
+    """Load a Matrix data file, return a list of DataArray as flatfile.load()"""
+
+    return MtrxFile(filename, mmap=mmap, parameter_file=parameter_file).getData()
@@ -29,11 +29,27 @@
 
 import os
 import re
+import sys
+import json
+import time
+import heapq
+import hashlib
+import tempfile
 import argparse
+import threading
 import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 debug = False
 
+# Name of the manifest in the Vernissage output folder, see load_manifest()
+MANIFEST_NAME = 'mtrx2flat_manifest.json'
+MANIFEST_VERSION = 1
+
+# Size in bytes of the blocks read to hash the source files
+HASH_BLOCK_SIZE = 2**20
+
 parser = argparse.ArgumentParser(description='''A script to facilitate
 the automatic conversion of STM data with Omicron VernissageCmd and/or
 Gwyexport (Gwyddion).''', epilog='''Developped by François Bianco (fbianco) –
@@ -65,6 +81,21 @@ parser.add_argument('-R', '--recursive', default=False, action='store_true',
 parser.add_argument('--overwrite', default=False, action='store_true',
     help='''Overwrite files if output folders exist. Please double check what
 you are doing, since it could results in file overwritten/destroyed.''')
+parser.add_argument('-j', '--jobs', type=int,
+    default=multiprocessing.cpu_count(),
+    help='Number of conversions run at once, default the number of CPUs.')
+parser.add_argument('--timeout', type=float, default=None,
+    help='Stop a conversion still running after TIMEOUT seconds.')
+parser.add_argument('--manifest', default=None,
+    help='''Manifest of the converted files, by default %s in the Vernissage
+output folder. Only the folders with new or modified files are converted
+again, unless --overwrite is given.''' % MANIFEST_NAME)
+parser.add_argument('-n', '--dry-run', default=False, action='store_true',
+    help='''Print the planned conversions, largest first, with their
+estimated time from the speed of the previous runs, and exit.''')
+parser.add_argument('--logfolder', default=None,
+    help='''Save the output of the conversion of each folder in a log file of
+LOGFOLDER, by default only the output of failed conversions is printed.''')
 
 # Input folders containing data
 parser.add_argument('inputfolders', nargs='+',
@@ -86,49 +117,452 @@ def build_command_list(cmd, flags='', arguments={}):
 
     return command_list
 
-def convert(dirname, args, stdout=None, stderr=None):
+def manifest_path(args):
+    return args.manifest or os.path.join(args.vernissageoutfolder, MANIFEST_NAME)
+
+def load_manifest(path):
+    """Return the manifest saved in path, or an empty one. For each converted
+    folder, named relative to the current directory as its output folder,
+    it holds the size, modification time and SHA-1 hash of the source files
+    and the converted files of each of them."""
+
+    manifest = {'version': MANIFEST_VERSION, 'folders': {}}
+    try:
+        with open(path) as manifest_file:
+            saved = json.load(manifest_file)
+    except IOError: # first run
+        return manifest
+    except ValueError, error:
+        print 'WARNING: Ignoring the invalid manifest %s: %s' % (path, error)
+        return manifest
+
+    if saved.get('version') == MANIFEST_VERSION:
+        manifest['folders'] = saved['folders']
+        if 'bytes_per_second' in saved:
+            manifest['bytes_per_second'] = saved['bytes_per_second']
+    return manifest
+
+def save_manifest(manifest, path):
+    """Write the manifest through a temporary file, so it is never left
+    partially written."""
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+        try:
+            os.rename(temp_path, path)
+        except OSError: # Windows cannot rename over an existing file
+            os.remove(path)
+            os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as source_file:
+        for block in iter(lambda: source_file.read(HASH_BLOCK_SIZE), ''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def source_files(dirname):
+    """Return {name: (size, mtime)} of the Matrix files in dirname"""
+
+    sources = {}
+    for name in os.listdir(dirname):
+        path = os.path.join(dirname, name)
+        if name.lower().endswith('mtrx') and os.path.isfile(path):
+            stat = os.stat(path)
+            sources[name] = (stat.st_size, stat.st_mtime)
+    return sources
+
+def changed_files(dirname, sources, record):
+    """Return the names of the sources of dirname which are new or modified
+    since the record of the folder in the manifest. The files are hashed only
+    if their size or modification time changed, the record of the files whose
+    content did not change is updated."""
+
+    changed = []
+    for name, (size, mtime) in sorted(sources.items()):
+        known = record['files'].get(name)
+        if known is None:
+            changed.append(name)
+        elif (known['size'], known['mtime']) != (size, mtime):
+            if known['sha1'] is not None and \
+               known['sha1'] == file_hash(os.path.join(dirname, name)):
+                known['size'], known['mtime'] = size, mtime # only touched
+            else:
+                changed.append(name)
+    return changed
+
+def folder_record(dirname, sources, outdir, record=None):
+    """Return the manifest record of dirname converted in outdir. The hashes
+    of the files unchanged since record are reused."""
+
+    files = {}
+    for name, (size, mtime) in sources.items():
+        known = (record or {'files': {}})['files'].get(name)
+        if known is not None and (known['size'], known['mtime']) == (size, mtime):
+            sha1 = known['sha1']
+        else:
+            sha1 = file_hash(os.path.join(dirname, name))
+        files[name] = {'size': size, 'mtime': mtime, 'sha1': sha1,
+                       'outputs': []}
+
+    # Vernissage names the flat files after their source, e.g. *.Z_mtrx
+    # gives *.Z_flat, the other outputs are only listed for the folder.
+    outputs = sorted(name for name in os.listdir(outdir)
+                     if os.path.isfile(os.path.join(outdir, name)))
+    for name in outputs:
+        if name.lower().endswith('flat') and name[:-4] + 'mtrx' in files:
+            files[name[:-4] + 'mtrx']['outputs'].append(name)
+
+    return {'outdir': outdir, 'files': files, 'outputs': outputs}
+
+def prepare(dirname, args, manifest=None):
+    """Create the output folder of dirname, return the conversion job, a
+    dictionary with the 'dirname', 'command', 'outdir' and 'sources', or
+    None if the folder is skipped. With a manifest, a folder already
+    converted is skipped if none of its files is new or modified."""
+
     current_dirpath = os.path.relpath(dirname)
 
     if not args.novernissage: # Do Vernissage convertion
         vernissageout_dirpath = os.path.join(args.vernissageoutfolder,
                                            current_dirpath)
+        sources = source_files(dirname)
+        if manifest is not None:
+            record = manifest['folders'].get(current_dirpath)
+
         if not os.path.isdir(vernissageout_dirpath):
-            if args.verbose: print 'Creating %s' % vernissageout_dirpath
-            os.mkdir(vernissageout_dirpath)
-        elif not args.overwrite: # dir exist + do not overwrite
-            return
+            if not args.dry_run:
+                if args.verbose: print 'Creating %s' % vernissageout_dirpath
+                os.makedirs(vernissageout_dirpath)
+        elif args.overwrite:
+            pass
+        elif manifest is None: # dir exist + do not overwrite
+            return None
+        elif record is None:
+            # Converted before the manifest was used, the files are taken as
+            # they are and hashed only once modified.
+            manifest['folders'][current_dirpath] = {
+                'outdir': vernissageout_dirpath, 'outputs': [],
+                'files': dict((name, {'size': size, 'mtime': mtime,
+                                      'sha1': None, 'outputs': []})
+                              for name, (size, mtime) in sources.items())}
+            return None
+        else:
+            changed = changed_files(dirname, sources, record)
+            if not changed:
+                return None
+            if args.verbose and not args.dry_run:
+                print '%i new or modified file(s) in %s' % (len(changed),
+                                                           current_dirpath)
 
-        # vernissage
-        subprocess.call(build_command_list(
+        job = {'dirname': dirname,
+               'outdir': vernissageout_dirpath,
+               'sources': sources,
+               'cost': sum(size for size, mtime in sources.values()),
+               'command': build_command_list(
                     args.vernissagecmd, args.vernissageflags,
                     {'{path}': current_dirpath,
                      '{outdir}': vernissageout_dirpath,
-                     '{exporter}': args.vernissageexporter}),
-                     stdout=stdout, stderr=stderr)
+                     '{exporter}': args.vernissageexporter})}
 
-def process(inputfolder, args, stdout=None, stderr=None):
+        if manifest is not None:
+            # The folder is recorded without files until it is converted, so
+            # all its files are converted again if the job fails.
+            job['record'] = record
+            manifest['folders'][current_dirpath] = {
+                'outdir': vernissageout_dirpath, 'files': {}, 'outputs': []}
+
+        # vernissage
+        return job
+
+def run_command(command, timeout=None):
+    """Run command, killed after timeout seconds if given. Return a dictionary
+    with its 'status' ('ok', 'failed', 'timeout' or 'error' if it could not
+    be started), 'returncode', captured 'stdout' and 'stderr' and 'time'."""
+
+    start = time.time()
+    try:
+        child = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+    except OSError, error:
+        return {'status': 'error', 'returncode': None, 'stdout': '',
+                'stderr': str(error), 'time': time.time() - start}
+
+    killed = threading.Event()
+    def kill():
+        killed.set()
+        try:
+            child.kill()
+        except OSError: # already finished
+            pass
+
+    timer = threading.Timer(timeout, kill) if timeout else None
+    if timer is not None:
+        timer.start()
+    try:
+        stdout, stderr = child.communicate()
+    finally:
+        if timer is not None:
+            timer.cancel()
+
+    if killed.is_set():
+        status = 'timeout'
+    elif child.returncode != 0:
+        status = 'failed'
+    else:
+        status = 'ok'
+    return {'status': status, 'returncode': child.returncode,
+            'stdout': stdout, 'stderr': stderr, 'time': time.time() - start}
+
+def convert(dirname, args, stdout=None, stderr=None):
+    """Convert the data of dirname, return the result of run_command() with
+    the 'dirname', or None if the folder is skipped. The output of the
+    command is written to stdout and stderr if given."""
+
+    job = prepare(dirname, args)
+    if job is None:
+        return None
+    return run_job(job, args, stdout, stderr)
+
+def run_job(job, args, stdout=None, stderr=None, manifest=None):
+    """Run a conversion job, return the result of run_command() with the
+    'dirname' and, if the job succeeded and a manifest is given, the new
+    'record' of the folder."""
+
+    result = run_command(job['command'], args.timeout)
+    result['dirname'] = job['dirname']
+    result['cost'] = job['cost']
+    if result['status'] == 'ok' and manifest is not None:
+        # The files are hashed in the worker threads
+        result['record'] = folder_record(job['dirname'], job['sources'],
+                                         job['outdir'], job['record'])
+    if stdout is not None:
+        stdout.write(result['stdout'])
+    if stderr is not None:
+        stderr.write(result['stderr'])
+    if args.logfolder:
+        save_log(result, args.logfolder)
+    return result
+
+def save_log(result, logfolder):
+    """Write the output of a conversion in a log file named after its folder"""
+
+    if not os.path.isdir(logfolder):
+        try:
+            os.makedirs(logfolder)
+        except OSError: # created by another job
+            pass
+    name = re.sub(r'[^\w.-]+', '_', os.path.relpath(result['dirname'])) + '.log'
+    with open(os.path.join(logfolder, name), 'w') as log:
+        log.write('%s %s after %.1f s, return code %s\n' % (result['dirname'],
+                  result['status'], result['time'], result['returncode']))
+        log.write(result['stdout'])
+        log.write(result['stderr'])
+
+def walk_folders(inputfolder, recursive):
+    """Return the list of the folders to convert in inputfolder: itself and,
+    if recursive, all its subfolders, each listed once."""
 
     data_dirpath = os.path.abspath(inputfolder)
 
     if not os.path.isdir(data_dirpath):
         print 'Error %s is not a directory.' % data_dirpath
-        return
+        return []
 
-    if not args.novernissage and not os.path.isdir(args.vernissageoutfolder):
+    if not recursive:
+        return [data_dirpath]
+    return [dirname for dirname, subdirnames, filenames in os.walk(data_dirpath)]
+
+def plan_jobs(inputfolders, args, manifest=None):
+    """Prepare the conversion jobs of all the folders of inputfolders, each
+    folder once even if it is found from several of them. Return the jobs
+    sorted by decreasing cost, the size of their Matrix files, so the
+    longest conversions start first and the pool finishes the smaller ones
+    in parallel."""
+
+    if not args.novernissage and not args.dry_run and \
+       not os.path.isdir(args.vernissageoutfolder):
         os.mkdir(args.vernissageoutfolder)
 
-    for dirname, subdirnames, filenames in os.walk(data_dirpath):
-        convert(dirname, args, stdout, stderr)
+    dirnames = []
+    for inputfolder in inputfolders:
+        if args.verbose and not args.dry_run:
+            print 'Converting data in %s' % inputfolder
+        dirnames.extend(walk_folders(inputfolder, args.recursive))
+
+    jobs = []
+    seen = set()
+    for dirname in dirnames:
+        key = os.path.normcase(dirname)
+        if key in seen:
+            continue
+        seen.add(key)
+        job = prepare(dirname, args, manifest)
+        if job is not None:
+            jobs.append(job)
+
+    # Stable sort, the folders of the same cost stay in walk order
+    jobs.sort(key=lambda job: job['cost'], reverse=True)
+    return jobs
+
+def collect_jobs(inputfolder, args, manifest=None):
+    """Prepare the folders of inputfolder to convert, return the list of
+    jobs, see plan_jobs()."""
+
+    return plan_jobs([inputfolder], args, manifest)
+
+def estimate_time(jobs, workers, bytes_per_second):
+    """Return the estimated time of each job and of the whole run, with the
+    jobs started in order on workers parallel workers."""
+
+    times = [job['cost'] / bytes_per_second for job in jobs]
+    finish = [0.0] * max(1, workers)
+    for duration in times:
+        heapq.heapreplace(finish, finish[0] + duration)
+    return times, max(finish)
+
+def format_size(size):
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if size < 1024:
+            return '%.1f %s' % (size, unit)
+        size /= 1024.
+    return '%.1f TB' % size
+
+def print_plan(jobs, args, manifest=None):
+    """Print the planned jobs in their order, with their estimated time if
+    the speed of the previous runs is known."""
+
+    workers = max(1, min(args.jobs, len(jobs)))
+    bytes_per_second = (manifest or {}).get('bytes_per_second')
+    if bytes_per_second:
+        times, total = estimate_time(jobs, workers, bytes_per_second)
+    else:
+        times, total = [None] * len(jobs), None
+
+    print '%i folder(s) to convert, %s of Matrix files, %i parallel job(s)' % (
+            len(jobs), format_size(sum(job['cost'] for job in jobs)), workers)
+    for job, duration in zip(jobs, times):
+        print '  %10s %10s  %s' % (format_size(job['cost']),
+                '~%.0f s' % duration if duration is not None else '',
+                os.path.relpath(job['dirname']))
+    if total is not None:
+        print 'Estimated time %.0f s at %s/s, the speed of the previous runs' % (
+                total, format_size(bytes_per_second))
+    else:
+        print 'No previous run to estimate the time from'
+
+def update_speed(manifest, results):
+    """Record the conversion speed of the successful jobs in the manifest,
+    used by print_plan() to estimate the next runs."""
 
-        if args.recursive:
-            for subdirname in subdirnames:
-                convert(os.path.join(dirname, subdirname), args, stdout, stderr)
+    done = [result for result in results if result['status'] == 'ok']
+    size = sum(result['cost'] for result in done)
+    duration = sum(result['time'] for result in done)
+    if size > 0 and duration > 0:
+        manifest['bytes_per_second'] = size / duration
+
+def run_jobs(jobs, args, stdout=None, stderr=None, manifest=None):
+    """Run the conversion jobs in a pool of args.jobs threads, each one waits
+    for its own converter process. Return the list of results, in the order
+    they finished. If given, the manifest is updated and saved after each
+    successful job, so an interrupted run is resumed where it stopped."""
+
+    results = []
+    if not jobs:
+        return results
+
+    pool = ThreadPool(max(1, min(args.jobs, len(jobs))))
+    try:
+        for result in pool.imap_unordered(
+                lambda job: run_job(job, args, stdout, stderr, manifest), jobs):
+            results.append(result)
+            if 'record' in result:
+                manifest['folders'][os.path.relpath(result['dirname'])] = \
+                    result.pop('record')
+                save_manifest(manifest, manifest_path(args))
+            if args.verbose:
+                print '[%i/%i] %-7s %7.1f s %s' % (len(results), len(jobs),
+                        result['status'], result['time'], result['dirname'])
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return results
+
+def print_summary(results, elapsed):
+    """Print the number of conversions of each status and the output of the
+    failed ones."""
+
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+
+    print
+    print 'Converted %i folder(s) in %.1f s (%.1f s of conversions)' % (
+            len(results), elapsed, sum(result['time'] for result in results))
+    for status in ('ok', 'failed', 'timeout', 'error'):
+        if status in counts:
+            print '  %-7s %i' % (status, counts[status])
+
+    for result in results:
+        if result['status'] == 'ok':
+            continue
+        print
+        print '%s %s (return code %s)' % (result['dirname'], result['status'],
+                                          result['returncode'])
+        for line in (result['stdout'] + result['stderr']).splitlines()[-10:]:
+            print '    ' + line
+
+def open_manifest(args):
+    """Return the manifest used by the conversions of args, or None"""
+
+    if args.novernissage:
+        return None
+    if not args.dry_run and not os.path.isdir(args.vernissageoutfolder):
+        os.mkdir(args.vernissageoutfolder)
+    return load_manifest(manifest_path(args))
+
+def convert_folders(inputfolders, args, stdout=None, stderr=None):
+    """Plan and run the conversion of inputfolders, return the list of
+    results. With args.dry_run, only print the plan."""
+
+    manifest = open_manifest(args)
+    jobs = plan_jobs(inputfolders, args, manifest)
+    if args.dry_run:
+        print_plan(jobs, args, manifest)
+        return []
+    if args.verbose and jobs:
+        print_plan(jobs, args, manifest)
+
+    if manifest is not None: # records of the folders found up to date
+        save_manifest(manifest, manifest_path(args))
+    results = run_jobs(jobs, args, stdout, stderr, manifest)
+    if manifest is not None and results:
+        update_speed(manifest, results)
+        save_manifest(manifest, manifest_path(args))
+    return results
+
+def process(inputfolder, args, stdout=None, stderr=None):
+    """Convert the data in inputfolder, return the list of results"""
+
+    return convert_folders([inputfolder], args, stdout, stderr)
 
 def main():
     args = parser.parse_args()
-    for inputfolder in args.inputfolders:
-        if args.verbose: print 'Converting data in %s' % inputfolder
-        process(inputfolder, args)
+    start = time.time()
+    results = convert_folders(args.inputfolders, args)
+    if args.dry_run:
+        return
+    print_summary(results, time.time() - start)
+    if any(result['status'] != 'ok' for result in results):
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
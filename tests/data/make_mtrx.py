@@ -0,0 +1,123 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+    Write the synthetic Matrix session of tests/data/mtrx, see flatfile_mtrx
+    for the layout of the blocks.
+
+    The session holds a 6x4 topography scanned in the four directions, then
+    a 11 points I(V) spectroscopy with ramp reversal, the gap voltage is
+    modified in between. The raw values are consecutive integers so the
+    tests can compute the expected physical values.
+
+        python tests/data/make_mtrx.py
+"""
+
+import os
+import struct
+import numpy as np
+
+FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mtrx')
+PREFIX = 'default_2016Apr21-101010_STM-STM_Spectroscopy'
+TIMESTAMP = 1461234567
+
+def pack_int(value):
+    return struct.pack('<i', value)
+
+def pack_double(value):
+    return struct.pack('<d', value)
+
+def pack_string(text):
+    if not text:
+        return pack_int(0)
+    return pack_int(len(text)) + text.encode('utf-16-le')
+
+def pack_value(value):
+    if isinstance(value, bool):
+        return pack_int(3) + pack_int(int(value))
+    elif isinstance(value, int):
+        return pack_int(1) + pack_int(value)
+    elif isinstance(value, float):
+        return pack_int(2) + pack_double(value)
+    return pack_int(5) + pack_string(value)
+
+def block(tag, content, timestamp=True):
+    if timestamp:
+        content = struct.pack('<q', TIMESTAMP) + content
+    return tag[::-1] + pack_int(len(content)) + content
+
+def eepa(elements):
+    content = pack_int(0) + pack_int(len(elements))
+    for instance, parameters in elements:
+        content += pack_string(instance) + pack_int(len(parameters))
+        for name, unit, value in parameters:
+            content += pack_string(name) + pack_string(unit) + pack_int(0) + \
+                       pack_value(value)
+    return block('EEPA', content)
+
+def pmod(instance, name, unit, value):
+    return block('PMOD', pack_int(0) + pack_string(instance) +
+                 pack_string(name) + pack_string(unit) + pack_int(0) +
+                 pack_value(value))
+
+def bref(name):
+    return block('BREF', pack_int(0) + pack_string(name))
+
+def dict_block(channels):
+    content = pack_int(1) + '\0' * 16 + pack_string(u'X') + pack_string(u'm')
+    content += pack_int(len(channels))
+    for name, channelId, unit in channels:
+        content += pack_int(0) + pack_int(channelId) + '\0' * 8 + \
+                   pack_string(name) + pack_string(unit)
+    return block('DICT', content)
+
+def xfer(functions):
+    content = ''
+    for channelId, name, unit, parameters in functions:
+        content += pack_int(channelId) + pack_string(name) + \
+                   pack_string(unit) + pack_int(len(parameters))
+        for parameter, value in parameters:
+            content += pack_string(parameter) + pack_value(value)
+    return block('XFER', content)
+
+def data_file(name, counts):
+    content = block('DESC', '\0' * 24, False) + \
+              block('DATA', counts.astype('<i4').tostring(), False)
+    with open(os.path.join(FOLDER, name), 'wb') as dataFile:
+        dataFile.write('ONTMATRX0101' + block('BKLT', content))
+
+def main():
+    if not os.path.isdir(FOLDER):
+        os.makedirs(FOLDER)
+
+    chain = 'ONTMATRX0101'
+    chain += eepa([
+        (u'XYScanner', [(u'Points', u'--', 6), (u'Lines', u'--', 4),
+                        (u'Width', u'm', 6e-9), (u'Height', u'm', 8e-9),
+                        (u'X_Retrace', u'--', True),
+                        (u'Y_Retrace', u'--', True)]),
+        (u'Regulator', [(u'Setpoint_1', u'A', 1e-10)]),
+        (u'GapVoltageControl', [(u'Voltage', u'V', 1.5)]),
+        (u'Spectroscopy', [(u'Device_1_Points', u'--', 11),
+                           (u'Device_1_Start', u'V', -1.0),
+                           (u'Device_1_End', u'V', 1.0),
+                           (u'Enable_Device_1_Ramp_Reversal', u'--', True)])])
+    chain += block('CCSY',
+        dict_block([(u'Z', 1, u'm'), (u'I(V)', 2, u'A')]) +
+        xfer([(1, u'TFF_Linear1D', u'm', [(u'Factor', 2.0), (u'Offset', 1.0)]),
+              (2, u'TFF_Linear1D', u'A', [(u'Factor', 4.0), (u'Offset', 0.0)])]))
+
+    name = PREFIX + '--1_1.Z_mtrx'
+    data_file(name, np.arange(12 * 8) - 48)
+    chain += bref(name)
+
+    chain += pmod(u'GapVoltageControl', u'Voltage', u'V', -2.0)
+    name = PREFIX + '--2_1.I(V)_mtrx'
+    data_file(name, np.arange(22) * 10)
+    chain += bref(name)
+
+    with open(os.path.join(FOLDER, PREFIX + '_0001.mtrx'), 'wb') as chainFile:
+        chainFile.write(chain)
+
+if __name__ == "__main__":
+    main()
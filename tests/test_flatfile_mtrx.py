@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Parse the synthetic Matrix session of tests/data/mtrx, written by
+    tests/data/make_mtrx.py. TestMtrxLayout checks the bytes of the session
+    at fixed offsets against the layout of the format, independently of the
+    writer and of the reader.
+
+        python -m unittest discover tests
+"""
+
+import os
+import sys
+import struct
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import flatfile
+import flatfile_mtrx
+
+FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'mtrx')
+PREFIX = 'default_2016Apr21-101010_STM-STM_Spectroscopy'
+
+def path(name):
+    return os.path.join(FOLDER, PREFIX + name)
+
+class TestMtrxFile(unittest.TestCase):
+
+    def setUp(self):
+        flatfile.memoryCache.clear()
+
+    def test_parameter_file_name(self):
+        self.assertEqual(flatfile_mtrx.parameter_file_name(path('--1_1.Z_mtrx')),
+                         path('_0001.mtrx'))
+        self.assertRaises(flatfile.UnhandledFileError,
+                          flatfile_mtrx.parameter_file_name, 'topo.Z_flat')
+
+    def test_topography(self):
+        data = flatfile_mtrx.load(path('--1_1.Z_mtrx'))
+        self.assertEqual([dataArray.direction for dataArray in data],
+                         ['up-fwd', 'up-bwd', 'down-fwd', 'down-bwd'])
+
+        info = data[0].info
+        self.assertEqual((info['xres'], info['yres']), (6, 4))
+        self.assertAlmostEqual(info['xreal'], 6.0) # nm
+        self.assertEqual(info['vgap'], 1.5)
+        self.assertEqual(info['unit'], u'm')
+
+        counts = (np.arange(12 * 8) - 48).reshape(8, 12)
+        np.testing.assert_allclose(data[0].data, (counts[:4, :6] - 1.0) / 2.0)
+        np.testing.assert_allclose(data[3].data,
+                                   (counts[:3:-1, :5:-1] - 1.0) / 2.0)
+
+    def test_spectroscopy(self):
+        data = flatfile_mtrx.load(path('--2_1.I(V)_mtrx'))
+        self.assertEqual([dataArray.direction for dataArray in data],
+                         ['fwd', 'bwd'])
+
+        info = data[0].info
+        self.assertEqual(info['vres'], 11)
+        self.assertEqual(info['vstart'], -1.0)
+        self.assertAlmostEqual(info['vinc'], 0.2)
+        self.assertEqual(info['vgap'], -2.0) # modified after the topography
+        self.assertEqual(info['unit'], u'A')
+
+        counts = np.arange(22) * 10
+        np.testing.assert_allclose(data[0].data, counts[:11] / 4.0)
+        np.testing.assert_allclose(data[1].data, counts[:10:-1] / 4.0)
+
+    def test_mmap_and_header_only(self):
+        mapped = flatfile_mtrx.load(path('--1_1.Z_mtrx'), mmap=True)
+        loaded = flatfile_mtrx.load(path('--1_1.Z_mtrx'))
+        for mappedArray, dataArray in zip(mapped, loaded):
+            np.testing.assert_allclose(np.asarray(mappedArray.data),
+                                       dataArray.data)
+
+        header = flatfile_mtrx.MtrxFile(path('--1_1.Z_mtrx'), header_only=True)
+        self.assertTrue(all(dataArray.counts is None
+                            for dataArray in header.getData()))
+
+def read(name):
+    with open(path(name), 'rb') as mtrxFile:
+        return mtrxFile.read()
+
+class TestMtrxLayout(unittest.TestCase):
+
+    def test_data_file(self):
+        content = read('--1_1.Z_mtrx')
+        self.assertEqual(len(content), 452)
+        self.assertEqual(content[:12], 'ONTMATRX0101')
+        # BKLT: tag, size, timestamp, then the DESC and DATA blocks
+        self.assertEqual(content[12:16], 'TLKB')
+        self.assertEqual(struct.unpack_from('<iq', content, 16),
+                         (432, 1461234567))
+        self.assertEqual(content[28:32], 'CSED')
+        self.assertEqual(struct.unpack_from('<i', content, 32), (24,))
+        # DATA: no timestamp, the raw values start right after the size
+        self.assertEqual(content[60:64], 'ATAD')
+        self.assertEqual(struct.unpack_from('<iii', content, 64), (384, -48, -47))
+        self.assertEqual(struct.unpack_from('<i', content, 448), (47,))
+
+        header = flatfile_mtrx.MtrxFile(path('--1_1.Z_mtrx'), header_only=True)
+        self.assertEqual((header.dataOffset, header.dataCount), (68, 96))
+        self.assertEqual(header.timestamp, 1461234567)
+
+    def test_parameter_file(self):
+        content = read('_0001.mtrx')
+        self.assertEqual(content[:12], 'ONTMATRX0101')
+        self.assertEqual(content[12:16], 'APEE')
+        self.assertEqual(struct.unpack_from('<iq', content, 16),
+                         (696, 1461234567))
+        self.assertEqual(content[716:720], 'YSCC')
+        self.assertEqual(content[732:736], 'TCID')
+
+        # XFER: timestamp, then the transfer function of the Z channel
+        self.assertEqual(content[846:850], 'REFX')
+        self.assertEqual(struct.unpack_from('<iq', content, 850),
+                         (204, 1461234567))
+        def utf16(text):
+            return text.encode('utf-16-le')
+        self.assertEqual(content[862:960],
+            '01000000'.decode('hex') + # channel id 1
+            '0c000000'.decode('hex') + utf16(u'TFF_Linear1D') +
+            '01000000'.decode('hex') + utf16(u'm') +
+            '02000000'.decode('hex') + # 2 parameters
+            '06000000'.decode('hex') + utf16(u'Factor') +
+            '02000000' '0000000000000040'.decode('hex') + # double 2.0
+            '06000000'.decode('hex') + utf16(u'Offset') +
+            '02000000' '000000000000f03f'.decode('hex')) # double 1.0
+
+        # BREF: timestamp, 4 bytes, name of the data file
+        name = PREFIX + '--1_1.Z_mtrx'
+        self.assertEqual(content[1058:1062], 'FERB')
+        self.assertEqual(struct.unpack_from('<iqii', content, 1062),
+                         (130, 1461234567, 0, len(name)))
+        self.assertEqual(content[1082:1082 + 2 * len(name)].decode('utf-16-le'),
+                         name)
+
+        header = flatfile_mtrx.MtrxFile(path('--1_1.Z_mtrx'), header_only=True)
+        self.assertEqual(header.transferFunctions[1], (u'TFF_Linear1D', u'm',
+                         {u'Factor': 2.0, u'Offset': 1.0}))
+        self.assertEqual(header.channels[u'Z'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
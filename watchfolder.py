@@ -0,0 +1,543 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""
+    Watch the acquisition and flat file folders, convert the new Matrix data
+    and add the new flat files to the database as they arrive.
+
+    The folders are scanned every few seconds, or as soon as something is
+    written if pyinotify is installed. A file is only used once its size and
+    modification time did not change for --settle seconds, so the files
+    still being written by Matrix or Vernissage are left alone.
+
+    The folders with new Matrix files are converted by a pool of
+    --convertjobs threads with mtrx2flat, its manifest keeps track of the
+    converted files. VernissageCmd converts a whole folder again, only the
+    flat files of the new or modified Matrix files are then added. The flat
+    files copied by hand in the flat folder are added once, and again only
+    if their content changed. The files are checked with flatfile.validate()
+    and added by a pool of --ingestjobs threads with BigBlue.add_entry().
+    Both pools are fed through bounded queues: when the database falls
+    behind, the conversions wait, and when both are busy, the scanner leaves
+    the new files for its next pass instead of piling them up in memory.
+
+    The output folders of mtrx2flat are named relative to the current
+    directory, the watcher works from the parent of the acquisition folder,
+    so the flat files of acquisition/day/ go to flatfolder/acquisition/day/.
+
+        python watchfolder.py -a D:\\Matrix\\data -u tgill D:\\bigblue_flat
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import Queue
+import getpass
+import logging
+import argparse
+import threading
+import mtrx2flat
+import flatfile as ff
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+# Name of the record of the ingested files in the flat folder
+STATE_NAME = 'watchfolder_state.json'
+STATE_VERSION = 2
+
+parser = argparse.ArgumentParser(description='''Convert and add to the
+database the STM data as they are acquired.''')
+
+parser.add_argument('flatfolder',
+    help='Folder of the flat files to add to the database.')
+parser.add_argument('-a', '--acquisition', default=None,
+    help='''Matrix data folder, its new files are converted to flat files in
+FLATFOLDER. Without it, only the flat files are added.''')
+parser.add_argument('-u', '--user', default=None,
+    help='Database user, by default the login name.')
+parser.add_argument('-p', '--password', default=None,
+    help='Database password, asked if not given.')
+parser.add_argument('--database', default='cryo_stm_data',
+    help='Database the files are added to.')
+parser.add_argument('--interval', type=float, default=2.,
+    help='Time in seconds between two scans of the folders.')
+parser.add_argument('--settle', type=float, default=5.,
+    help='Time in seconds a file must stay unchanged before it is used.')
+parser.add_argument('--rescan', type=float, default=300.,
+    help='''Time in seconds between two full scans of the folders when
+inotify tells which folders changed.''')
+parser.add_argument('--noinotify', default=False, action='store_true',
+    help='Poll the folders even if pyinotify is available.')
+parser.add_argument('--convertjobs', type=int, default=2,
+    help='Number of conversions run at once.')
+parser.add_argument('--ingestjobs', type=int, default=1,
+    help='''Number of files added to the database at once. BigBlue checks
+the existing entries before adding new ones, concurrent additions of files of
+the same experiment could duplicate it, so the default is 1.''')
+parser.add_argument('--queuesize', type=int, default=100,
+    help='Number of waiting conversions and additions at most.')
+parser.add_argument('--state', default=None,
+    help='Record of the added files, by default %s in FLATFOLDER.' % STATE_NAME)
+parser.add_argument('--timeout', type=float, default=None,
+    help='Stop a conversion still running after TIMEOUT seconds.')
+parser.add_argument('--vernissagecmd',
+    default=mtrx2flat.parser.get_default('vernissagecmd'),
+    help='Path/Executable name for VernissageCmd.exe')
+parser.add_argument('--vernissageflags',
+    default=mtrx2flat.parser.get_default('vernissageflags'),
+    help='Vernissage command flags, see mtrx2flat.')
+parser.add_argument('--vernissageexporter',
+    default=mtrx2flat.parser.get_default('vernissageexporter'),
+    help='Vernissage exporter plug-in name.')
+
+logger = logging.getLogger('watchfolder')
+
+def scan_folder(folder, suffix, recursive=True):
+    """Yield (path, size, mtime) of the files of folder whose name ends with
+    suffix, in any case."""
+
+    if recursive:
+        walk = os.walk(folder)
+    else:
+        try:
+            walk = [(folder, [], os.listdir(folder))]
+        except OSError: # removed since
+            return
+    for dirname, subdirnames, filenames in walk:
+        for name in filenames:
+            if not name.lower().endswith(suffix):
+                continue
+            path = os.path.join(dirname, name)
+            try:
+                stat = os.stat(path)
+            except OSError: # removed since
+                continue
+            yield path, stat.st_size, stat.st_mtime
+
+def record_outputs(record):
+    """Return the paths of the flat files converted from the sources of a
+    mtrx2flat manifest record."""
+
+    return set(os.path.abspath(os.path.join(record['outdir'], name))
+               for entry in record['files'].values()
+               for name in entry['outputs'])
+
+class Debouncer():
+    """Tell when a file stopped changing. Only the files not handled yet
+       are followed, they are forgotten once handled or removed."""
+
+    def __init__(self, settle):
+        self.settle = settle
+        self.seen = {} # path: (size, mtime, first time seen so)
+        self.pending = set() # paths not stable yet
+
+    def isStable(self, path, size, mtime, now):
+        """Return True if the file did not change since the previous call for
+           settle seconds, or was already last modified settle seconds ago. """
+
+        previous = self.seen.get(path)
+        if previous is None or previous[:2] != (size, mtime):
+            self.seen[path] = (size, mtime, now)
+            self.pending.add(path)
+            return False
+        if now - previous[2] >= self.settle or now - mtime >= self.settle:
+            self.pending.discard(path)
+            return True
+        return False
+
+    def forget(self, path):
+        self.seen.pop(path, None)
+        self.pending.discard(path)
+
+    def prune(self, present, folders=None):
+        """Forget the files of folders, or of all the folders if None,
+           which are not in present any more."""
+
+        for path in self.seen.keys():
+            if path not in present and \
+               (folders is None or os.path.dirname(path) in folders):
+                self.forget(path)
+
+    def pendingFolders(self):
+        """Return the folders of the files not stable yet"""
+
+        return set(os.path.dirname(path) for path in self.pending)
+
+class Watcher():
+    """Scan the folders and feed the conversion and ingest pools."""
+
+    def __init__(self, args):
+        self.args = args
+        self.flatfolder = os.path.abspath(args.flatfolder)
+        self.acquisition = args.acquisition and os.path.abspath(args.acquisition)
+        self.statePath = args.state and os.path.abspath(args.state) or \
+                         os.path.join(self.flatfolder, STATE_NAME)
+        if not os.path.isdir(self.flatfolder):
+            os.makedirs(self.flatfolder)
+        if self.acquisition is not None:
+            # mtrx2flat names the output folders after the input folders
+            # relative to the current directory
+            os.chdir(os.path.dirname(self.acquisition))
+
+        self.convertArgs = mtrx2flat.parser.parse_args(
+            ['--quiet', self.acquisition or '.'])
+        self.convertArgs.vernissageoutfolder = self.flatfolder
+        for option in ('vernissagecmd', 'vernissageflags',
+                       'vernissageexporter', 'timeout'):
+            setattr(self.convertArgs, option, getattr(args, option))
+        self.manifest = mtrx2flat.load_manifest(
+            mtrx2flat.manifest_path(self.convertArgs))
+
+        # Ingested files, path: [size, mtime, sha1, error or None]
+        self.state = self._loadState()
+        self.stateChanged = False
+
+        # Flat files converted by the watcher, only added again when their
+        # source is modified
+        self.convertedOutputs = set()
+        for record in self.manifest['folders'].values():
+            self.convertedOutputs.update(record_outputs(record))
+
+        self.lock = threading.Lock()
+        self.saveLock = threading.Lock() # saves of the manifest in order
+        self.stop = threading.Event()
+        self.wake = threading.Event()
+        self.dirty = set() # folders changed, reported by inotify
+
+        self.convertQueue = Queue.Queue(args.queuesize)
+        self.ingestQueue = Queue.Queue(args.queuesize)
+        self.converting = set() # folders queued or being converted
+        self.ingesting = set() # files queued or being added
+        self.failed = {} # Sources of the failed conversions by folder
+
+        self.debouncer = Debouncer(args.settle)
+        self.notifier = None
+
+    def _loadState(self):
+        try:
+            with open(self.statePath) as stateFile:
+                state = json.load(stateFile)
+        except IOError: # first run
+            return {}
+        except ValueError, error:
+            logger.warning('Ignoring the invalid state %s: %s', self.statePath, error)
+            return {}
+        if state.get('version') != STATE_VERSION:
+            return {}
+        return state['files']
+
+    def saveState(self):
+        with self.lock:
+            if not self.stateChanged:
+                return
+            state = {'version': STATE_VERSION, 'files': dict(self.state)}
+            self.stateChanged = False
+        mtrx2flat.save_manifest(state, self.statePath)
+
+    def saveManifest(self):
+        """Save the mtrx2flat manifest. The records of the folders are
+           replaced, never modified, so a copy of the folders is enough."""
+
+        with self.saveLock:
+            with self.lock:
+                manifest = dict(self.manifest)
+                manifest['folders'] = dict(self.manifest['folders'])
+            mtrx2flat.save_manifest(manifest,
+                                    mtrx2flat.manifest_path(self.convertArgs))
+
+    #
+    # Scanner
+    #
+
+    def startInotify(self):
+        """Watch the folders with inotify, return False if not available"""
+
+        if pyinotify is None or self.args.noinotify:
+            return False
+
+        watcher = self
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                with watcher.lock:
+                    watcher.dirty.add(event.path)
+                watcher.wake.set()
+
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | \
+               pyinotify.IN_CREATE | pyinotify.IN_MODIFY
+        manager = pyinotify.WatchManager()
+        for folder in (self.flatfolder, self.acquisition):
+            if folder is not None:
+                manager.add_watch(folder, mask, rec=True, auto_add=True)
+        self.notifier = pyinotify.ThreadedNotifier(manager, Handler())
+        self.notifier.daemon = True
+        self.notifier.start()
+        return True
+
+    def scan(self, folders=None):
+        """Dispatch the stable new files of the watched folders, or only of
+           folders if given. The folders of the files left out because a
+           queue is full are scanned again at the next pass."""
+
+        now = time.time()
+        sources = []
+        if self.acquisition is not None:
+            sources.append((self.acquisition, 'mtrx', self.isConverted,
+                            self.dispatchMatrix))
+        sources.append((self.flatfolder, 'flat', self.isAdded,
+                        self.dispatchFlat))
+
+        present = set()
+        full = set()
+        for root, suffix, isDone, dispatch in sources:
+            if folders is None:
+                files = scan_folder(root, suffix)
+            else:
+                files = (entry for folder in folders
+                         if folder == root or folder.startswith(root + os.sep)
+                         for entry in scan_folder(folder, suffix, False))
+            for path, size, mtime in files:
+                present.add(path)
+                if isDone(path, size, mtime):
+                    self.debouncer.forget(path)
+                elif self.debouncer.isStable(path, size, mtime, now):
+                    if dispatch(path, size, mtime):
+                        self.debouncer.forget(path)
+                    else:
+                        full.add(os.path.dirname(path))
+
+        self.debouncer.prune(present, folders)
+        if full:
+            with self.lock:
+                self.dirty.update(full)
+
+    def isConverted(self, path, size, mtime):
+        """Return True if the Matrix file is converted, or its conversion
+           failed, as it is."""
+
+        dirname, name = os.path.split(path)
+        key = os.path.relpath(dirname)
+        with self.lock:
+            record = self.manifest['folders'].get(key)
+            failed = self.failed.get(key, {})
+        if failed.get(name) == (size, mtime):
+            return True
+        entry = record and record['files'].get(name)
+        return entry is not None and (entry['size'], entry['mtime']) == (size, mtime)
+
+    def isAdded(self, path, size, mtime):
+        """Return True if the flat file does not need to be added. The flat
+           files converted by the watcher are queued by convert() instead,
+           once added."""
+
+        with self.lock:
+            known = self.state.get(path)
+        return known is not None and (known[:2] == [size, mtime] or
+                                      path in self.convertedOutputs)
+
+    def dispatchMatrix(self, path, size, mtime):
+        """Queue the conversion of the folder of a new or modified Matrix
+           file, return False if the queue is full. A file modified during
+           the conversion of its folder is queued again afterwards."""
+
+        dirname = os.path.dirname(path)
+        with self.lock:
+            if dirname not in self.converting:
+                try:
+                    self.convertQueue.put_nowait(dirname)
+                except Queue.Full:
+                    return False
+                self.converting.add(dirname)
+        return True
+
+    def dispatchFlat(self, path, size, mtime):
+        """Queue the addition of a new or modified flat file, return False if
+           the queue is full."""
+
+        with self.lock:
+            if path in self.ingesting:
+                return True
+            try:
+                self.ingestQueue.put_nowait(path)
+            except Queue.Full:
+                return False
+            self.ingesting.add(path)
+        return True
+
+    def run(self):
+        """Scan the folders until interrupted"""
+
+        inotify = self.startInotify()
+        logger.info('Watching %s%s with %s', self.flatfolder,
+                    ' and %s' % self.acquisition if self.acquisition else '',
+                    'inotify' if inotify else 'polling')
+
+        workers = [threading.Thread(target=self.convertWorker)
+                   for i in range(max(1, self.args.convertjobs))] + \
+                  [threading.Thread(target=self.ingestWorker)
+                   for i in range(max(1, self.args.ingestjobs))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        lastFullScan = 0
+        try:
+            while not self.stop.is_set():
+                with self.lock:
+                    dirty, self.dirty = self.dirty, set()
+                if not inotify or time.time() - lastFullScan >= self.args.rescan:
+                    lastFullScan = time.time()
+                    self.scan()
+                else:
+                    self.scan(dirty | self.debouncer.pendingFolders())
+                self.saveState()
+                self.wake.wait(self.args.interval)
+                self.wake.clear()
+        except KeyboardInterrupt:
+            logger.info('Stopping')
+        finally:
+            self.stop.set()
+            if self.notifier is not None:
+                self.notifier.stop()
+            for worker in workers: # finish the current conversions
+                worker.join(self.args.timeout)
+            self.saveState()
+
+    #
+    # Workers
+    #
+
+    def convertWorker(self):
+        while not self.stop.is_set():
+            try:
+                dirname = self.convertQueue.get(timeout=1)
+            except Queue.Empty:
+                continue
+            try:
+                self.convert(dirname)
+            except Exception:
+                logger.exception('Conversion of %s failed', dirname)
+            finally:
+                with self.lock:
+                    self.converting.discard(dirname)
+
+    def convert(self, dirname):
+        """Convert the new Matrix files of dirname, then queue the new flat
+           files for addition, waiting while the ingest queue is full."""
+
+        # The sources are listed and hashed on a copy of the record of the
+        # folder, so the other threads do not wait for them
+        key = os.path.relpath(dirname)
+        with self.lock:
+            record = self.manifest['folders'].get(key)
+        manifest = {'folders': {}}
+        if record is not None:
+            manifest['folders'][key] = copy.deepcopy(record)
+        job = mtrx2flat.prepare(dirname, self.convertArgs, manifest)
+        if key in manifest['folders']:
+            with self.lock:
+                self.manifest['folders'][key] = manifest['folders'][key]
+        if job is None:
+            return
+
+        logger.info('Converting %s', dirname)
+        result = mtrx2flat.run_job(job, self.convertArgs, manifest=manifest)
+        if result['status'] != 'ok':
+            logger.error('Conversion of %s %s: %s', dirname, result['status'],
+                         (result['stdout'] + result['stderr']).strip())
+            # Converted again once one of the sources is modified
+            with self.lock:
+                self.failed[key] = job['sources']
+            return
+
+        record = result['record']
+        with self.lock:
+            self.failed.pop(key, None)
+            self.manifest['folders'][key] = record
+            self.convertedOutputs.update(record_outputs(record))
+        self.saveManifest()
+        logger.info('Converted %s in %.1f s', dirname, result['time'])
+
+        # The converter exited, its outputs are complete. All the outputs of
+        # the folder are written again, only those of the new or modified
+        # sources are added.
+        previous = (job['record'] or {'files': {}})['files']
+        changed = dict((name, entry) for name, entry in record['files'].items()
+                       if name not in previous or
+                          previous[name]['sha1'] != entry['sha1'])
+        for path in record_outputs({'outdir': record['outdir'],
+                                    'files': changed}):
+            with self.lock:
+                if path in self.ingesting:
+                    continue
+                self.ingesting.add(path)
+            while not self.stop.is_set():
+                try:
+                    self.ingestQueue.put(path, timeout=1)
+                    break
+                except Queue.Full:
+                    pass
+
+    def ingestWorker(self):
+        while not self.stop.is_set():
+            try:
+                path = self.ingestQueue.get(timeout=1)
+            except Queue.Empty:
+                continue
+            try:
+                self.ingest(path)
+            finally:
+                with self.lock:
+                    self.ingesting.discard(path)
+
+    def ingest(self, path):
+        """Check and add a flat file to the database. The file is recorded
+           with its size and hash, and its error if it fails, so it is only
+           tried again once its content is modified."""
+
+        try:
+            stat = os.stat(path)
+            sha1 = mtrx2flat.file_hash(path)
+        except (OSError, IOError): # removed since
+            return
+
+        with self.lock:
+            known = self.state.get(path)
+            if known is not None and known[0] == stat.st_size and \
+               known[2] == sha1: # only touched
+                known[1] = stat.st_mtime
+                self.stateChanged = True
+                return
+
+        error = None
+        try:
+            ff.validate(path)
+            import BigBlue_dbFunc as bb # needs MySQLdb, only for the ingest
+            entry = bb.BigBlue(self.args.user, self.args.password, path,
+                               database=self.args.database)
+            entry.add_entry()
+            logger.info('Added %s', path)
+        except Exception, error:
+            logger.error('Unable to add %s: %s', path, error)
+            error = str(error)
+
+        with self.lock:
+            self.state[path] = [stat.st_size, stat.st_mtime, sha1, error]
+            self.stateChanged = True
+
+def main():
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+        format='%(asctime)s: %(name)s - [%(levelname)s] %(message)s')
+    if args.user is None:
+        args.user = getpass.getuser()
+    if args.password is None:
+        args.password = getpass.getpass('Database password for %s: ' % args.user)
+    Watcher(args).run()
+
+if __name__ == "__main__":
+    main()